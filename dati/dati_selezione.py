@@ -9,22 +9,76 @@ https://www.epicentro.iss.it/coronavirus/bollettino/Bollettino-sorveglianza-inte
 
 Requirements:
 Python 3.6+, Ghostscript (ghostscript), Tkinter (python3-tk)
-numpy, pandas, camelot, PyMuPDF, Beautiful Soup 4 """
+numpy, pandas, pyarrow, camelot, PyMuPDF, Beautiful Soup 4 """
 
 
+import argparse
+import hashlib
+import json
 import locale
+import pickle
 import re
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
-from os import chdir, path
+from glob import glob
+from os import chdir, getpid, makedirs, path, remove, replace, stat, utime
 from urllib import request
+from urllib.error import HTTPError
 from urllib.parse import urljoin
 
 import camelot
 import fitz
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from bs4 import BeautifulSoup
 
+import iss_store
+from iss_store import (STORE_SCHEMA_VERSION, append_to_log, has_store, read_log,
+                       read_xlsx_data, repair_log, store_log_path, store_paths,
+                       upsert_rows)
+
+# Local store of the downloaded reports
+PDF_CACHE_DIR = path.join("cache", "pdf")
+
+# Reports already fetched (or revalidated) during this run
+fetched_reports = {}
+
+# Local cache of the extracted tables, keyed by the pdf hash.
+# Bump PARSER_VERSION when the extraction or cleaning of the tables changes
+TABLE_CACHE_DIR = path.join("cache", "tables")
+TABLE_CACHE_MAX_BYTES = 50 * 1024**2
+PARSER_VERSION = "2"
+
+# Fingerprints of the rows of the store, by key (data or data|età)
+STORE_INDEX_DIR = "cache"
+
+# Geometry of the last table extracted by camelot, for each table letter
+TABLE_HINTS_FILE = path.join("cache", "table_hints.json")
+
+# The store (parquet files and log) is read through iss_store.py.
+# New rows are appended to a checksummed log, replayed when reading
+# the store; the log is consolidated into the store (and the xlsx
+# are exported) every STORE_COMPACT_EVERY entries or with --compact.
+# update_all.sh runs --compact after each new report, so the published
+# xlsx are always up to date
+STORE_COMPACT_EVERY = 8
+
+
+# Tables to extract from each report, e.g. "TABELLA 5A - POPOLAZIONE ITALIANA"
+TABLE_QUERY = r"TABELLA [0-9]([A-C]) - POPOLAZIONE ITALIANA"
+TABLE_LETTERS = ("A", "B", "C")
+
+# Table extraction engines:
+# camelot (default), fitz (PyMuPDF word boxes, camelot as fallback),
+# check (both, compared)
+TABLE_ENGINES = ("camelot", "fitz", "check")
+
+
+class ExtractionError(Exception):
+    """Raised when the tables can't be extracted from a report"""
+
 
 def get_surveillance_reports():
     """get_surveillance_reports() -> list
@@ -49,27 +103,128 @@ def get_surveillance_reports():
             if date_from_url(link["href"], is_raw=False) >= cut_date]
 
 
+def load_pdf_index(cache_dir=PDF_CACHE_DIR):
+    """load_pdf_index(str) -> dict
+
+    cache_dir: directory of the local pdf store
+    return: dictionary url -> {sha256, etag, last_modified}"""
+
+    index_file = path.join(cache_dir, "index.json")
+    if not path.exists(index_file):
+        return {}
+    with open(index_file, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_pdf_index(pdf_index, cache_dir=PDF_CACHE_DIR):
+    """save_pdf_index(dict, str)
+
+    pdf_index: dictionary url -> {sha256, etag, last_modified}
+    cache_dir: directory of the local pdf store
+    return: atomically writes the index of the store"""
+
+    index_file = path.join(cache_dir, "index.json")
+    tmp_file = f"{index_file}.{getpid()}.tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(pdf_index, f, indent=2)
+    replace(tmp_file, index_file)
+
+
+def fetch_report_pdf(sel_url, cache_dir=PDF_CACHE_DIR):
+    """fetch_report_pdf(str, str) -> str
+
+    sel_url: url of the report
+    cache_dir: directory of the local pdf store
+    return: path of the local copy of the report
+
+    The pdf is saved once under its sha256 and revalidated with
+    ETag/Last-Modified, so each report is downloaded at most once per run."""
+
+    if sel_url in fetched_reports:
+        return fetched_reports[sel_url]
+
+    makedirs(cache_dir, exist_ok=True)
+    pdf_index = load_pdf_index(cache_dir)
+    entry = pdf_index.get(sel_url)
+
+    # Ask the server only for changed content
+    req = request.Request(sel_url)
+    if entry is not None and path.exists(path.join(cache_dir, entry["sha256"] + ".pdf")):
+        if entry.get("etag"):
+            req.add_header("If-None-Match", entry["etag"])
+        if entry.get("last_modified"):
+            req.add_header("If-Modified-Since", entry["last_modified"])
+    else:
+        entry = None
+
+    try:
+        with request.urlopen(req) as response:
+            content = response.read()
+            headers = response.headers
+    except HTTPError as e:
+        if e.code != 304 or entry is None:
+            raise
+        # Not modified: reuse the local copy
+        print(f"\nUsing cached report {entry['sha256'][:12]}")
+        pdf_path = path.join(cache_dir, entry["sha256"] + ".pdf")
+        fetched_reports[sel_url] = pdf_path
+        return pdf_path
+
+    sha256 = hashlib.sha256(content).hexdigest()
+    pdf_path = path.join(cache_dir, sha256 + ".pdf")
+    if not path.exists(pdf_path):
+        tmp_file = f"{pdf_path}.{getpid()}.tmp"
+        with open(tmp_file, "wb") as f:
+            f.write(content)
+        replace(tmp_file, pdf_path)
+
+    pdf_index[sel_url] = {"sha256": sha256,
+                          "etag": headers.get("ETag"),
+                          "last_modified": headers.get("Last-Modified")}
+    save_pdf_index(pdf_index, cache_dir)
+    fetched_reports[sel_url] = pdf_path
+    return pdf_path
+
+
+def find_tables(page, found_tables):
+    """find_tables(fitz.Page, dict)
+
+    page: page of the report
+    found_tables: dictionary table letter -> page number
+    return: adds the tables found in the page (the first page wins)"""
+
+    for letter in re.findall(TABLE_QUERY, page.get_text(), re.IGNORECASE):
+        letter = letter.upper()
+        if letter not in found_tables:
+            n = page.number + 1
+            print(f"Found: {n} ({letter})")
+            found_tables[letter] = n
+
+
 def pages_from_url(sel_url):
     """page_from_url(str) -> list
 
     sel_url: url of the report
-    return: numbers of the pages containing the tables"""
+    return: (page number, table letter) of the tables, sorted by letter"""
+
+    with fitz.open(fetch_report_pdf(sel_url)) as pdf:
+        print("\nSearching for the selected table...")
+        found_tables = {}
 
-    query = "TABELLA [0-9][A-C] - POPOLAZIONE ITALIANA"
+        # The outline, if available, points to the pages of the tables
+        toc_pages = sorted({entry[2] for entry in pdf.get_toc()
+                            if re.search("TABELLA", entry[1], re.IGNORECASE)
+                            and 1 <= entry[2] <= pdf.page_count})
+        for n in toc_pages:
+            find_tables(pdf[n - 1], found_tables)
 
-    with request.urlopen(sel_url) as response:
-        content = response.read()
-        with fitz.open(stream=content, filetype="pdf") as pdf:
-            print("\nSearching for the selected table...")
-            # Query for string
-            found_pages = []
-            for page in pdf:
-                text = page.get_text()
-                if re.search(query, text, re.IGNORECASE):
-                    n = page.number + 1
-                    print(f"Found: {n}")
-                    found_pages.append(n)
-    return found_pages
+        # Otherwise query each page, until all the tables are found
+        for page in pdf:
+            if len(found_tables) == len(TABLE_LETTERS):
+                break
+            find_tables(page, found_tables)
+    return sorted(((n, letter) for letter, n in found_tables.items()),
+                  key=lambda table: table[1])
 
 
 def date_from_url(sel_url, is_raw=True):
@@ -89,48 +244,227 @@ def check_df(sel_df):
     sel_df: dataframe
     return: Check if the table has at least 2 columns."""
 
-    error_msg = "Can't extract the table! DIY!"
     if len(sel_df.columns) < 3:
         # Table is incomplete, bye bye
-        print(error_msg)
-        exit()
+        raise ExtractionError("Can't extract the table! DIY!")
+
+
+def load_table_hints(hints_file=TABLE_HINTS_FILE):
+    """load_table_hints(str) -> dict
+
+    hints_file: path of the hints
+    return: dictionary table letter -> {table_areas, columns, n_rows, n_cols}"""
+
+    if not path.exists(hints_file):
+        return {}
+    with open(hints_file, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_table_hint(letter, sel_table, n_rows, hints_file=TABLE_HINTS_FILE):
+    """save_table_hint(str, camelot.core.Table, int, str)
+
+    letter: table letter
+    sel_table: table extracted by camelot
+    n_rows: number of rows of the clean table
+    hints_file: path of the hints
+    return: saves area and column separators of the table"""
 
+    # camelot bbox is (left, bottom, right, top),
+    # table_areas wants "left,top,right,bottom"
+    left, bottom, right, top = sel_table._bbox
+    separators = [col[1] for col in sel_table.cols[:-1]]
+    hint = {"table_areas": [f"{left:.2f},{top:.2f},{right:.2f},{bottom:.2f}"],
+            "columns": [",".join(f"{x:.2f}" for x in separators)],
+            "n_rows": n_rows,
+            "n_cols": len(sel_table.df.columns)}
 
-def get_raw_table(sel_url, table):
-    """get_raw_table(str, int) -> df
+    hints = load_table_hints(hints_file)
+    if hints.get(letter) == hint:
+        return
+    hints[letter] = hint
+    makedirs(path.dirname(hints_file), exist_ok=True)
+    tmp_file = f"{hints_file}.{getpid()}.tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(hints, f, indent=2)
+    replace(tmp_file, hints_file)
+
+
+def check_table_totals(clean_df):
+    """check_table_totals(df) -> boolean
+
+    clean_df: clean dataframe
+    return: True if, in each block of 6 rows (5 age groups and the total),
+    the total row is the sum of the age groups"""
+
+    n_blocks = len(clean_df) // 6
+    if n_blocks == 0:
+        return False
+    blocks = clean_df.to_numpy()[:n_blocks*6].reshape(n_blocks, 6, -1)
+    return bool(np.array_equal(blocks[:, :5].sum(axis=1), blocks[:, 5]))
+
+
+def is_valid_table(df_raw, n_rows=None, n_cols=None):
+    """is_valid_table(df, int, int) -> boolean
+
+    df_raw: raw dataframe
+    n_rows: expected number of rows of the clean table (None: at least 12)
+    n_cols: expected number of columns of the raw table (None: any)
+    return: True if the table has the expected shape, all the cells
+    are parsed and the totals add up"""
+
+    if n_cols is not None and len(df_raw.columns) != n_cols:
+        return False
+    try:
+        clean_df = clean_raw_table(df_raw)
+    except ValueError:
+        return False
+    rows_ok = len(clean_df) >= 12 if n_rows is None else len(clean_df) == n_rows
+    return (rows_ok
+            and not clean_df.attrs["parse_failures"]
+            and check_table_totals(clean_df))
+
+
+def get_raw_table(sel_url, table, letter=None):
+    """get_raw_table(str, int, str) -> df
 
     sel_url: url of the report
     table: the page number of the table
+    letter: the table letter, to use and update the learned hints
     return: raw dataframe"""
 
-    # Read the found page using camelot
-    tables = camelot.read_pdf(sel_url,
+    pdf_path = fetch_report_pdf(sel_url)
+
+    # Try first the geometry of the last table with the same letter
+    hint = load_table_hints().get(letter)
+    if hint is not None:
+        tables = camelot.read_pdf(pdf_path,
+                                  pages=f"{table}",
+                                  flavor="stream",
+                                  table_areas=hint["table_areas"],
+                                  columns=hint["columns"])
+        # Same shape as the learned table, and the totals add up
+        if tables.n and is_valid_table(tables[0].df, hint["n_rows"], hint.get("n_cols")):
+            return tables[0].df
+        print(f"\nThe layout of table {letter} has changed, detecting the table...")
+
+    # Read the found page of the local copy using camelot
+    tables = camelot.read_pdf(pdf_path,
                               pages=f"{table}",
                               flavor="stream")
-    df_raw = tables[0].df
+    sel_table = tables[0]
 
     # Check if there are enough columns
-    if len(df_raw.columns) < 5:
+    if len(sel_table.df.columns) < 5:
         if len(tables) >= 1:
-            df_raw = tables[1].df
-        check_df(df_raw)
+            sel_table = tables[1]
+        check_df(sel_table.df)
     # Check if there are enough rows
-    elif len(clean_raw_table(df_raw)) < 12:
+    elif len(clean_raw_table(sel_table.df)) < 12:
         print(f"\nThere was an error with table on page {table}. Improving detected area...")
-        tables = camelot.read_pdf(sel_url,
+        tables = camelot.read_pdf(pdf_path,
                                   pages=f"{table}",
                                   flavor="stream",
                                   edge_tol=500)
-        df_raw = tables[0].df
-        check_df(df_raw)
-    return df_raw
+        sel_table = tables[0]
+        check_df(sel_table.df)
+
+    # Learn the geometry of a complete and consistent table
+    if letter is not None and is_valid_table(sel_table.df):
+        save_table_hint(letter, sel_table, len(clean_raw_table(sel_table.df)))
+    return sel_table.df
+
+
+def merge_split_numbers(df_words):
+    """merge_split_numbers(df) -> df
+
+    df_words: numeric words of the page, grouped into rows
+    return: words with the numbers split by a space (e.g. "1 234") joined"""
+
+    df_words = df_words.sort_values(["row", "x0"])
+    gap = df_words["x0"] - df_words["x1"].shift()
+    height = df_words["y1"] - df_words["y0"]
+    # A group of 3 digits, closer to the previous number of the row than a column
+    joined = ((df_words["row"] == df_words["row"].shift())
+              & (gap < height/2)
+              & df_words["word"].str.fullmatch(r"[0-9]{3}"))
+    return (df_words.groupby((~joined).cumsum())
+            .agg(x0=("x0", "min"), y0=("y0", "min"),
+                 x1=("x1", "max"), y1=("y1", "max"),
+                 word=("word", "".join), row=("row", "first"))
+            .reset_index(drop=True))
+
+
+def table_from_words(words, n_cols=6):
+    """table_from_words(list, int) -> df
+
+    words: words of the page, as (x0, y0, x1, y1, word, ...)
+    n_cols: number of numeric columns of the table
+    return: raw dataframe of the last n_cols numeric columns.
+    Raises ExtractionError if a row doesn't fill exactly the columns"""
+
+    # Keep only the numbers: labels and percentages "(12,3%)" are discarded
+    df_words = pd.DataFrame([word[:5] for word in words],
+                            columns=["x0", "y0", "x1", "y1", "word"])
+    df_words = df_words[df_words["word"].str.match(r"^[0-9][0-9.]*$")]
+    if df_words.empty:
+        raise ExtractionError("no numbers found")
+
+    # Group the words into rows by the vertical position
+    yc = (df_words["y0"] + df_words["y1"])/2
+    df_words = df_words.assign(yc=yc).sort_values(["yc", "x0"])
+    tol = (df_words["y1"] - df_words["y0"]).median()/2
+    df_words["row"] = (df_words["yc"].diff() > tol).cumsum()
+    df_words = merge_split_numbers(df_words)
+
+    # Rows of the table, other numbers (e.g. page number) are discarded
+    counts = df_words.groupby("row")["word"].transform("size")
+    df_words = df_words[counts >= 3]
+    if df_words.empty:
+        raise ExtractionError("no table found")
+
+    # Columns: the words of a column overlap horizontally,
+    # whatever their alignment, in all the rows
+    df_words = df_words.sort_values("x0")
+    df_words["col"] = (df_words["x0"] > df_words["x1"].cummax().shift()).cumsum()
+    n_found = df_words["col"].max() + 1
+    if n_found < n_cols:
+        raise ExtractionError(f"only {n_found} columns")
+    df_words = df_words[df_words["col"] >= n_found - n_cols]
+    df_words["col"] -= n_found - n_cols
+
+    # Each row must have exactly one number per column
+    cells = df_words.groupby("row")["col"].agg(["size", "nunique"])
+    wrong_rows = (cells["size"] != n_cols) | (cells["nunique"] != n_cols)
+    if wrong_rows.any():
+        raise ExtractionError(f"{wrong_rows.sum()} rows don't match the {n_cols} columns")
+
+    df_raw = df_words.pivot(index="row", columns="col", values="word")
+    df_raw.columns.name = None
+    return df_raw.reset_index(drop=True)
+
+
+def get_raw_table_fitz(sel_url, table):
+    """get_raw_table_fitz(str, int) -> df
+
+    sel_url: url of the report
+    table: the page number of the table
+    return: raw dataframe of the last 6 numeric columns,
+    rebuilt from the coordinates of the words of the page"""
+
+    with fitz.open(fetch_report_pdf(sel_url)) as pdf:
+        words = pdf[table - 1].get_text("words")
+    return table_from_words(words)
 
 
 def clean_raw_table(sel_df):
     """clean_raw_table(df) -> df
 
     sel_df: raw dataframe
-    return: extract numerical data from the dataframe"""
+    return: extract numerical data from the dataframe.
+    The cells that are neither a number nor empty (e.g. "n.d." or
+    a footnoted number) keep only their digits, 0 if there are none,
+    and are listed in df.attrs["parse_failures"] as (row, column, value)"""
 
     # We are interested in the last 6 columns
     df_raw = sel_df.iloc[:, -6:]
@@ -138,10 +472,22 @@ def clean_raw_table(sel_df):
     # select rows containing numbers
     df_raw = df_raw[df_raw[df_raw.columns[0]].str.match(r"[0-9]")]
 
-    # Remove empty cells, dots and parentheses
-    df_final = df_raw.replace(r"\((.*)|[^0-9]", "", regex=True)
-    df_final = df_final.apply(lambda x: x.str.strip())
-    df_final = df_final.replace(r"^\s*$", 0, regex=True).apply(np.int64)
+    # Parse all the cells at once: remove dots and parentheses,
+    # empty cells are 0
+    cells = pd.Series(df_raw.to_numpy().ravel(), dtype=object).astype(str)
+    numbers = cells.str.replace(r"\((.*)|[^0-9]", "", regex=True).to_numpy()
+    numbers = np.where(numbers == "", "0", numbers).astype(np.int64)
+    df_final = pd.DataFrame(numbers.reshape(df_raw.shape),
+                            index=df_raw.index, columns=df_raw.columns)
+
+    # Cells that are neither a number nor empty (or a dash)
+    valid = (cells.str.replace(r"\((.*)", "", regex=True)
+             .str.fullmatch(r"\s*(?:[0-9][0-9.\s]*|[-–]?)\s*"))
+    n_cols = df_raw.shape[1]
+    df_final.attrs["parse_failures"] = [(df_raw.index[k // n_cols],
+                                         df_raw.columns[k % n_cols],
+                                         cells[k])
+                                        for k in np.flatnonzero(~valid.to_numpy())]
 
     # Merge columns "Vaccinati con ciclo completo da >120 giorni",
     # "Vaccinati con ciclo completo da <=120 giorni",
@@ -154,6 +500,120 @@ def clean_raw_table(sel_df):
     return df_final
 
 
+def extract_table(sel_url, table, letter=None, engine="camelot"):
+    """extract_table(str, int, str, str) -> df, df
+
+    sel_url: url of the report
+    table: the page number of the table
+    letter: the table letter
+    engine: "camelot", "fitz" or "check" (see TABLE_ENGINES)
+    return: raw and clean dataframes
+
+    The PyMuPDF table is used only if each row fills exactly the
+    columns and all the cells are parsed, otherwise camelot is used.
+    With "check" both are extracted and compared."""
+
+    if engine == "camelot":
+        df_raw = get_raw_table(sel_url, table, letter)
+        return df_raw, report_parse_failures(clean_raw_table(df_raw), table)
+
+    try:
+        raw_fitz = get_raw_table_fitz(sel_url, table)
+        clean_fitz = clean_raw_table(raw_fitz)
+        if len(clean_fitz) < 12:
+            raise ExtractionError(f"only {len(clean_fitz)} rows")
+        if clean_fitz.attrs["parse_failures"]:
+            raise ExtractionError(f"{len(clean_fitz.attrs['parse_failures'])} cells not parsed")
+    except (ExtractionError, ValueError) as e:
+        print(f"\nPyMuPDF extraction failed on page {table} ({e}), using camelot...")
+        df_raw = get_raw_table(sel_url, table, letter)
+        return df_raw, report_parse_failures(clean_raw_table(df_raw), table)
+
+    if engine == "check":
+        raw_camelot = get_raw_table(sel_url, table, letter)
+        clean_camelot = clean_raw_table(raw_camelot)
+        if clean_camelot.shape != clean_fitz.shape \
+                or not np.array_equal(clean_camelot.to_numpy(), clean_fitz.to_numpy()):
+            print(f"\nPyMuPDF and camelot tables differ on page {table}, using camelot")
+            return raw_camelot, report_parse_failures(clean_camelot, table)
+        print(f"\nPyMuPDF and camelot tables match on page {table}")
+    return raw_fitz, clean_fitz
+
+
+def table_cache_path(sel_url, engine, cache_dir=TABLE_CACHE_DIR):
+    """table_cache_path(str, str, str) -> str
+
+    sel_url: url of the report
+    engine: table extraction engine
+    cache_dir: directory of the tables cache
+    return: path of the cached tables of the report"""
+
+    # The local copy of the report is named after its sha256
+    sha256 = path.splitext(path.basename(fetch_report_pdf(sel_url)))[0]
+    return path.join(cache_dir, f"{sha256}_{PARSER_VERSION}_{engine}.pkl")
+
+
+def load_cached_tables(cache_file):
+    """load_cached_tables(str) -> dict
+
+    cache_file: path of the cached tables
+    return: dictionary with pages, raw and clean tables (None if not cached)"""
+
+    if not path.exists(cache_file):
+        return None
+    # Mark as recently used
+    utime(cache_file)
+    with open(cache_file, "rb") as f:
+        return pickle.load(f)
+
+
+def save_cached_tables(cache_file, tables, max_bytes=TABLE_CACHE_MAX_BYTES):
+    """save_cached_tables(str, dict, int)
+
+    cache_file: path of the cached tables
+    tables: dictionary with pages, raw and clean tables
+    max_bytes: maximum size of the cache
+    return: atomically writes the tables, then evicts the
+    least recently used entries above max_bytes"""
+
+    cache_dir = path.dirname(cache_file)
+    makedirs(cache_dir, exist_ok=True)
+    tmp_file = f"{cache_file}.{getpid()}.tmp"
+    with open(tmp_file, "wb") as f:
+        pickle.dump(tables, f)
+    replace(tmp_file, cache_file)
+
+    entries = []
+    for filename in glob(path.join(cache_dir, "*.pkl")):
+        try:
+            file_stat = stat(filename)
+        except FileNotFoundError:
+            continue
+        entries.append((file_stat.st_mtime, file_stat.st_size, filename))
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, filename in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        # Another worker may have removed it already
+        try:
+            remove(filename)
+        except FileNotFoundError:
+            pass
+        total_bytes -= size
+
+
+def report_parse_failures(clean_df, table):
+    """report_parse_failures(df, int) -> df
+
+    clean_df: clean dataframe
+    table: the page number of the table
+    return: prints the cells that can't be parsed, returns clean_df"""
+
+    for row, col, value in clean_df.attrs["parse_failures"]:
+        print(f"Can't parse {value!r} (page {table}, row {row}, column {col}), set to 0")
+    return clean_df
+
+
 def extract_data_main(clean_tables):
     totals_epidem = []
     totals_pop = []
@@ -187,22 +647,24 @@ def extract_data_by_age(clean_tables):
     return df_epid_eta, df_pop_eta
 
 
-def add_new_row(sel_df, results):
-    """add_new_row(df, list)
+def new_row(columns, results, rep_date):
+    """new_row(list, list, datetime) -> df
 
-    sel_df: selected dataframe
+    columns: columns list
     results: list of integers
-    return: add the new row at the top of the selected df"""
-    sel_df.loc[rep_date] = results
-    sel_df.sort_index(ascending=False, inplace=True)
-    return sel_df.apply(np.int64)
+    rep_date: date of the report
+    return: dataframe with the row of rep_date"""
+    sel_df = pd.DataFrame([results], columns=columns,
+                          index=pd.DatetimeIndex([rep_date], name="data"))
+    return sel_df.astype(np.int64)
 
 
-def add_index_cols(sel_df, columns):
-    """add_index_cols(df, list)
+def add_index_cols(sel_df, columns, rep_date):
+    """add_index_cols(df, list, datetime)
 
     sel_df: selected dataframe
     columns: columns list
+    rep_date: date of the report
     return: dataframe with index and columns"""
     sel_df.columns = columns
     sel_df.insert(0, "età", ["5-11", "12-39", "40-59", "60-79", "80+"])
@@ -217,11 +679,201 @@ def merge_df_into_xlsx(df_0, df_1, filename="dati_ISS_complessivi.xlsx"):
     df_0: epidemiological data dataframe
     df_1: populations data dataframe
     filename: name of the output xlsx
-    return: merges two dataframes into an xlsx"""
+    return: merges two dataframes into an xlsx (export only)"""
 
-    with pd.ExcelWriter(filename) as writer:
+    # Write a temporary file, then replace the xlsx
+    root, ext = path.splitext(filename)
+    tmp_file = f"{root}.{getpid()}.tmp{ext}"
+    with pd.ExcelWriter(tmp_file) as writer:
         df_0.to_excel(writer, sheet_name="dati epidemiologici")
         df_1.to_excel(writer, sheet_name="popolazioni")
+    replace(tmp_file, filename)
+
+
+def write_store(df_0, df_1, filename="dati_ISS_complessivi"):
+    """write_store(df, df, str)
+
+    df_0: epidemiological data dataframe
+    df_1: populations data dataframe
+    filename: name of the dataset
+    return: atomically writes the dataframes into the parquet store"""
+
+    for sel_df, store_path in zip((df_0, df_1), store_paths(filename)):
+        # Keep (data, età) as index of the data by age
+        if "età" in sel_df.columns:
+            sel_df = sel_df.set_index("età", append=True)
+        table = pa.Table.from_pandas(sel_df)
+        metadata = {**table.schema.metadata,
+                    b"schema_version": STORE_SCHEMA_VERSION.encode()}
+        tmp_file = f"{store_path}.{getpid()}.tmp"
+        pq.write_table(table.replace_schema_metadata(metadata), tmp_file)
+        replace(tmp_file, store_path)
+
+
+def read_store(filename="dati_ISS_complessivi"):
+    """read_store(str) -> df, df
+
+    filename: name of the dataset
+    return: epidemiological and populations dataframes,
+    including the rows of the log.
+    The store is created from the xlsx if not available yet"""
+
+    if not has_store(filename):
+        df_0, df_1 = read_xlsx_data(f"{filename}.xlsx")
+        write_store(df_0, df_1, filename)
+    return iss_store.read_store(filename)
+
+
+def row_keys(sel_df):
+    """row_keys(df) -> list
+
+    sel_df: dataframe indexed by date
+    return: key of each row, date or date|età for the data by age"""
+
+    dates = sel_df.index.strftime("%Y-%m-%d")
+    if "età" in sel_df.columns:
+        return [f"{date}|{età}" for date, età in zip(dates, sel_df["età"])]
+    return list(dates)
+
+
+def row_fingerprints(sel_df):
+    """row_fingerprints(df) -> list
+
+    sel_df: dataframe
+    return: fingerprint of the values of each row"""
+
+    return [str(fingerprint) for fingerprint
+            in pd.util.hash_pandas_object(sel_df, index=False)]
+
+
+def store_index_path(filename):
+    """store_index_path(str) -> str
+
+    filename: name of the dataset
+    return: path of the fingerprints index of the dataset"""
+
+    return path.join(STORE_INDEX_DIR, f"{filename}_index.json")
+
+
+def store_stamp(filename="dati_ISS_complessivi"):
+    """store_stamp(str) -> list
+
+    filename: name of the dataset
+    return: modification times of the parquet files and of the log"""
+
+    log_file = store_log_path(filename)
+    return ([stat(store_path).st_mtime_ns for store_path in store_paths(filename)]
+            + [stat(log_file).st_mtime_ns if path.exists(log_file) else None])
+
+
+def save_store_index(df_0, df_1, filename="dati_ISS_complessivi"):
+    """save_store_index(df, df, str) -> dict
+
+    df_0: epidemiological data dataframe
+    df_1: populations data dataframe
+    filename: name of the dataset
+    return: builds and saves the fingerprints index of the store"""
+
+    epid_fingerprints = row_fingerprints(df_0)
+    store_index = {"store_stamp": store_stamp(filename),
+                   "columns": {"epid": list(df_0.columns), "pop": list(df_1.columns)},
+                   "epid": dict(zip(row_keys(df_0), epid_fingerprints)),
+                   "pop": dict(zip(row_keys(df_1), row_fingerprints(df_1))),
+                   # Epidemiological fingerprint -> key
+                   "fingerprints": dict(zip(epid_fingerprints, row_keys(df_0)))}
+
+    index_file = store_index_path(filename)
+    makedirs(path.dirname(index_file), exist_ok=True)
+    tmp_file = f"{index_file}.{getpid()}.tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(store_index, f)
+    replace(tmp_file, index_file)
+    return store_index
+
+
+def load_store_index(filename="dati_ISS_complessivi"):
+    """load_store_index(str) -> dict
+
+    filename: name of the dataset
+    return: fingerprints index of the store,
+    rebuilt if missing or older than the store and its log"""
+
+    index_file = store_index_path(filename)
+    if path.exists(index_file) and has_store(filename):
+        with open(index_file, encoding="utf-8") as f:
+            store_index = json.load(f)
+        if store_index.get("store_stamp") == store_stamp(filename):
+            return store_index
+    df_0, df_1 = read_store(filename)
+    return save_store_index(df_0, df_1, filename)
+
+
+def is_stored(store_index, df_0, df_1):
+    """is_stored(dict, df, df) -> boolean
+
+    store_index: fingerprints index of the store
+    df_0: epidemiological data dataframe
+    df_1: populations data dataframe
+    return: True if all the rows are already in the store, unchanged"""
+
+    return all(store_index[sheet].get(key) == fingerprint
+               for sheet, sel_df in (("epid", df_0), ("pop", df_1))
+               for key, fingerprint in zip(row_keys(sel_df), row_fingerprints(sel_df)))
+
+
+def save_data(df_0, df_1, filename="dati_ISS_complessivi", export_xlsx=True):
+    """save_data(df, df, str, boolean)
+
+    df_0: epidemiological data dataframe
+    df_1: populations data dataframe
+    filename: name of the dataset
+    export_xlsx: also export the dataframes into filename.xlsx
+    return: saves the whole dataframes, replacing the store and its log"""
+
+    # Refuse to drop a log with entries after a corrupted line
+    repair_log(filename)
+    write_store(df_0, df_1, filename)
+    # The rows of the log are now in the store
+    log_file = store_log_path(filename)
+    if path.exists(log_file):
+        remove(log_file)
+    save_store_index(df_0, df_1, filename)
+    if export_xlsx:
+        merge_df_into_xlsx(df_0, df_1, filename=f"{filename}.xlsx")
+
+
+def compact_store(filename="dati_ISS_complessivi", export_xlsx=True):
+    """compact_store(str, boolean)
+
+    filename: name of the dataset
+    export_xlsx: also export the dataframes into filename.xlsx
+    return: consolidates the log into the store, if there is anything
+    to consolidate or export.
+    A crash before the log is removed is harmless: replaying
+    the log on the new store gives the same rows"""
+
+    # Rewriting an unchanged xlsx would only change its timestamps
+    if has_store(filename) and not path.exists(store_log_path(filename)) \
+            and (not export_xlsx or path.exists(f"{filename}.xlsx")):
+        return
+    df_0, df_1 = read_store(filename)
+    save_data(df_0, df_1, filename, export_xlsx)
+
+
+def append_data(df_0, df_1, filename="dati_ISS_complessivi", export_xlsx=True):
+    """append_data(df, df, str, boolean)
+
+    df_0: new epidemiological rows
+    df_1: new populations rows
+    filename: name of the dataset
+    export_xlsx: also export the dataframes into filename.xlsx,
+    when the store is compacted
+    return: appends the new rows to the log, then compacts the store
+    if the log is long enough"""
+
+    append_to_log(df_0, df_1, filename)
+    if len(read_log(filename)) >= STORE_COMPACT_EVERY:
+        compact_store(filename, export_xlsx)
 
 
 def get_report(auto=True):
@@ -253,70 +905,188 @@ def get_report(auto=True):
     return rep_date, rep_url
 
 
-def get_data_from_report(force=False):
-    """get_data_from_report(boolean)
+def extract_report(rep_url, engine="camelot", rep_date=None):
+    """extract_report(str, str, datetime) -> tuple
 
-    The script saves data extracted from report.
-    Use force=True to skip checks and force data extraction"""
+    rep_url: url of the report
+    engine: table extraction engine (see TABLE_ENGINES)
+    rep_date: date of the report (default: parsed from the url)
+    return: date of the report, totals (epidemiological, populations)
+    and data by age (epidemiological, populations)"""
 
-    # Read the csv to update from the repo
-    df_complessivo = pd.read_excel("dati_ISS_complessivi.xlsx", sheet_name=None,
-                                   index_col="data", parse_dates=["data"])
-    df_0 = df_complessivo["dati epidemiologici"]
-    df_1 = df_complessivo["popolazioni"]
+    if rep_date is None:
+        rep_date = date_from_url(rep_url, is_raw=False)
 
-    # If table is already up-to-date stop the script
-    if rep_date in df_0.index and not force:
-        print("\nCSV are already up-to-date!")
-        exit()
+    # Tables already extracted from the same pdf
+    cache_file = table_cache_path(rep_url, engine)
+    tables = load_cached_tables(cache_file)
+    if tables is not None:
+        print(f"\nUsing cached tables {path.basename(cache_file)}")
+    else:
+        # Get tables pages
+        tables_pages = pages_from_url(rep_url)
+
+        # Failed to extract the tables
+        if tuple(letter for _, letter in tables_pages) != TABLE_LETTERS:
+            raise ExtractionError("An error occurred!")
+
+        # get and clean the raw tables
+        raw_clean = [extract_table(rep_url, n, letter, engine)
+                     for n, letter in tables_pages]
+        tables = {"pages": tables_pages,
+                  "raw": [raw for raw, _ in raw_clean],
+                  "clean": [clean for _, clean in raw_clean]}
+        save_cached_tables(cache_file, tables)
+    clean_tables = tables["clean"]
 
-    # Get tables pages
-    tables_pages = pages_from_url(rep_url)
+    # Finally, get the data
+    totals_epidem, totals_pop = extract_data_main(clean_tables)
+    df_epid_età, df_pop_età = extract_data_by_age(clean_tables)
+    return rep_date, totals_epidem, totals_pop, df_epid_età, df_pop_età
 
-    # Failed to extract the tables
-    if len(tables_pages) < 3:
-        print("An error occurred!")
-        exit()
 
-    # get and clean the raw tables
-    raw_tables = [get_raw_table(rep_url, n) for n in tables_pages]
-    clean_tables = [clean_raw_table(raw) for raw in raw_tables]
+def get_data_from_report(rep_date, rep_url, force=False, export_xlsx=True,
+                         engine="camelot"):
+    """get_data_from_report(datetime, str, boolean, boolean, str)
 
-    # Finally, get the data
+    The script saves data extracted from report.
+    Use force=True to skip checks and force data extraction
+    Use export_xlsx=False to never export the xlsx (see append_data)
+    Use engine to select the table extraction engine (see TABLE_ENGINES)"""
 
-    # Get general data
-    totals_epidem, totals_pop = extract_data_main(clean_tables)
+    # Fingerprints of the stored rows
+    store_index = load_store_index("dati_ISS_complessivi")
+
+    # If table is already up-to-date stop the script
+    if rep_date.strftime("%Y-%m-%d") in store_index["epid"] and not force:
+        print("\nCSV are already up-to-date!")
+        exit()
+
+    # Get the data
+    _, totals_epidem, totals_pop, df_epid_età, df_pop_età = extract_report(rep_url, engine)
 
     # Data not updated!
-    if totals_epidem in df_0.values.tolist():
+    new_epid = pd.DataFrame([totals_epidem]).astype(np.int64)
+    if row_fingerprints(new_epid)[0] in store_index["fingerprints"]:
         print("Data not updated! Exiting...")
         exit()
 
-    # Update the dataframes
-    add_new_row(df_0, totals_epidem)
-    add_new_row(df_1, totals_pop)
-    # Save to xlsx
-    merge_df_into_xlsx(df_0, df_1)
+    # New rows
+    columns_epid = store_index["columns"]["epid"]
+    columns_pop = store_index["columns"]["pop"]
+    df_0 = new_row(columns_epid, totals_epidem, rep_date)
+    df_1 = new_row(columns_pop, totals_pop, rep_date)
+    # Append to the store (compacted every STORE_COMPACT_EVERY reports)
+    append_data(df_0, df_1, export_xlsx=export_xlsx)
 
-    # Get data by age
-    df_epid_età, df_pop_età = extract_data_by_age(clean_tables)
     # Add index and columns to the dataframes
-    df_epid_età = add_index_cols(df_epid_età, df_0.columns)
-    df_pop_età = add_index_cols(df_pop_età, df_1.columns)
-
-    # Add the two df to dati_ISS_età.xlsx
-    df_età = pd.read_excel("dati_ISS_età.xlsx", sheet_name=None,
-                           index_col="data", parse_dates=["data"])
-    df_epid_età = pd.concat((df_epid_età, df_età["dati epidemiologici"]))
-    df_pop_età = pd.concat((df_pop_età, df_età["popolazioni"]))
-    df_epid_età.drop_duplicates(inplace=True)
-    df_pop_età.drop_duplicates(inplace=True)
-    merge_df_into_xlsx(df_epid_età, df_pop_età, filename="dati_ISS_età.xlsx")
+    df_epid_età = add_index_cols(df_epid_età, columns_epid, rep_date)
+    df_pop_età = add_index_cols(df_pop_età, columns_pop, rep_date)
+
+    # Insert or replace the rows of the report in dati_ISS_età
+    if is_stored(load_store_index("dati_ISS_età"), df_epid_età, df_pop_età):
+        print("\nData by age already up-to-date")
+    else:
+        append_data(df_epid_età, df_pop_età, filename="dati_ISS_età",
+                    export_xlsx=export_xlsx)
 
     print("\nDone!")
 
 
+def init_backfill_worker(reports, locale_name):
+    """init_backfill_worker(dict, str)
+
+    reports: local copies of the reports, url -> path
+    locale_name: locale of the main process
+    return: sets up a worker process, also when it is spawned
+    instead of forked: same locale, reports already downloaded"""
+
+    locale.setlocale(locale.LC_ALL, locale_name)
+    fetched_reports.update(reports)
+
+
+def backfill_reports(max_workers=None, export_xlsx=True, engine="camelot"):
+    """backfill_reports(int, boolean, str)
+
+    max_workers: number of worker processes (default: number of CPUs)
+    export_xlsx: also export the data into the xlsx
+    engine: table extraction engine (see TABLE_ENGINES)
+
+    Re-extracts every available report in parallel and merges all rows
+    into both xlsx with a single write. A report that fails is
+    reported and skipped, the others are still saved."""
+
+    reports = get_surveillance_reports()
+    print(f"\nBackfilling {len(reports)} reports...")
+
+    # Download sequentially: the workers only read the local copies
+    for rep_url in reports:
+        fetch_report_pdf(rep_url)
+
+    results = []
+    failed = []
+    # The workers may be spawned (macOS, Windows): they get the dates,
+    # the locale and the local copies from here, not from a fork
+    with ProcessPoolExecutor(max_workers=max_workers,
+                             initializer=init_backfill_worker,
+                             initargs=(dict(fetched_reports),
+                                       locale.setlocale(locale.LC_ALL))) as executor:
+        futures = {executor.submit(extract_report, rep_url, engine,
+                                   date_from_url(rep_url, is_raw=False)): rep_url
+                   for rep_url in reports}
+        for future in as_completed(futures):
+            rep_url = futures[future]
+            try:
+                results.append(future.result())
+            except Exception as e:
+                print(f"\nFailed {date_from_url(rep_url)}: {e!r}")
+                failed.append(rep_url)
+
+    if not results:
+        print("\nNo report extracted!")
+        return
+
+    df_0, df_1 = read_store("dati_ISS_complessivi")
+    df_età_epid, df_età_pop = read_store("dati_ISS_età")
+
+    rep_dates = pd.DatetimeIndex([result[0] for result in results], name="data")
+    new_0 = pd.DataFrame([result[1] for result in results],
+                         index=rep_dates, columns=df_0.columns)
+    new_1 = pd.DataFrame([result[2] for result in results],
+                         index=rep_dates, columns=df_1.columns)
+    new_epid_età = pd.concat([add_index_cols(result[3], df_0.columns, result[0])
+                              for result in results])
+    new_pop_età = pd.concat([add_index_cols(result[4], df_1.columns, result[0])
+                             for result in results])
+
+    # Insert or replace the rows of the re-extracted reports, save once
+    save_data(upsert_rows(df_0, new_0.astype(np.int64)),
+              upsert_rows(df_1, new_1.astype(np.int64)),
+              export_xlsx=export_xlsx)
+    save_data(upsert_rows(df_età_epid, new_epid_età),
+              upsert_rows(df_età_pop, new_pop_età),
+              filename="dati_ISS_età", export_xlsx=export_xlsx)
+
+    print(f"\nDone! {len(results)} reports extracted, {len(failed)} failed")
+    for rep_url in failed:
+        print(rep_url)
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract data from ISS reports")
+    parser.add_argument("--backfill", action="store_true",
+                        help="re-extract all the available reports")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of worker processes for --backfill")
+    parser.add_argument("--compact", action="store_true",
+                        help="consolidate the logs into the store and export the xlsx")
+    parser.add_argument("--no-xlsx", action="store_true",
+                        help="update only the parquet store, skip the xlsx export")
+    parser.add_argument("--engine", choices=TABLE_ENGINES, default="camelot",
+                        help="table extraction engine: camelot, PyMuPDF "
+                             "(camelot as fallback), or both compared")
+    args = parser.parse_args()
+
     # Set work directory for the script
     scriptpath = path.dirname(path.realpath(__file__))
     chdir(scriptpath)
@@ -324,10 +1094,24 @@ if __name__ == "__main__":
     # Set locale to "it" to parse the month correctly
     locale.setlocale(locale.LC_ALL, "it_IT.UTF-8")
 
-    # Get the report
-    # Use auto=False for manual selection
-    rep_date, rep_url = get_report()
-
-    # Get data
-    # Use force=True to skip the checks/for debug purposes
-    get_data_from_report()
+    if args.compact:
+        for filename in ("dati_ISS_complessivi", "dati_ISS_età"):
+            compact_store(filename, export_xlsx=not args.no_xlsx)
+    elif args.backfill:
+        backfill_reports(max_workers=args.workers,
+                         export_xlsx=not args.no_xlsx,
+                         engine=args.engine)
+    else:
+        # Get the report
+        # Use auto=False for manual selection
+        rep_date, rep_url = get_report()
+
+        # Get data
+        # Use force=True to skip the checks/for debug purposes
+        try:
+            get_data_from_report(rep_date, rep_url,
+                                 export_xlsx=not args.no_xlsx,
+                                 engine=args.engine)
+        except ExtractionError as e:
+            print(e)
+            exit()
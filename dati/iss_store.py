@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+""" iss_store.py
+
+Reading of the store of the ISS data, shared by dati_selezione.py
+and by the analysis scripts (scripts/custom/preprocessing_dataframe.py).
+
+The parquet store holds one file per sheet; the rows of the new
+reports are appended to a checksummed log and replayed when reading.
+The paths are relative to the working directory, e.g. "dati_ISS_età"
+from dati/ or "../dati/dati_ISS_età" from scripts/.
+
+Requirements:
+Python 3.6+, pandas, pyarrow, openpyxl """
+
+
+import hashlib
+import json
+from os import fsync, path
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+# The parquet store is the primary data format, the xlsx are exports
+STORE_SCHEMA_VERSION = "1"
+STORE_SHEETS = {"dati epidemiologici": "epid", "popolazioni": "pop"}
+
+
+def store_paths(filename):
+    """store_paths(str) -> list
+
+    filename: name of the dataset, e.g. dati_ISS_complessivi
+    return: paths of the parquet files (one per sheet)"""
+
+    return [f"{filename}_{suffix}.parquet" for suffix in STORE_SHEETS.values()]
+
+
+def store_log_path(filename):
+    """store_log_path(str) -> str
+
+    filename: name of the dataset
+    return: path of the log of the new rows"""
+
+    return f"{filename}_log.jsonl"
+
+
+def frame_to_payload(sel_df):
+    """frame_to_payload(df) -> dict
+
+    sel_df: dataframe indexed by date
+    return: columns and rows, serializable as json"""
+
+    sel_df = sel_df.reset_index()
+    sel_df["data"] = sel_df["data"].dt.strftime("%Y-%m-%d")
+    return {"columns": list(sel_df.columns), "rows": sel_df.values.tolist()}
+
+
+def payload_to_frame(payload):
+    """payload_to_frame(dict) -> df
+
+    payload: columns and rows (see frame_to_payload)
+    return: dataframe indexed by date"""
+
+    sel_df = pd.DataFrame(payload["rows"], columns=payload["columns"])
+    sel_df["data"] = pd.to_datetime(sel_df["data"])
+    return sel_df.set_index("data")
+
+
+def payload_checksum(payload):
+    """payload_checksum(dict) -> str
+
+    payload: entry of the log
+    return: sha256 of the entry"""
+
+    payload_json = json.dumps(payload, sort_keys=True, default=int)
+    return hashlib.sha256(payload_json.encode()).hexdigest()
+
+
+def scan_log(log_file):
+    """scan_log(str) -> list, int, int
+
+    log_file: path of the log
+    return: payloads of the valid lines, size in bytes of the valid
+    lines and number of lines after them (the first one is invalid).
+    A line is valid if it ends with a newline and its checksum matches"""
+
+    payloads = []
+    valid_size = 0
+    n_invalid = 0
+    with open(log_file, "rb") as f:
+        for line in f:
+            if n_invalid:
+                n_invalid += 1
+                continue
+            try:
+                entry = json.loads(line)
+                valid = (line.endswith(b"\n")
+                         and entry["sha256"] == payload_checksum(entry["payload"]))
+            except (ValueError, KeyError, TypeError):
+                valid = False
+            if not valid:
+                n_invalid = 1
+                continue
+            payloads.append(entry["payload"])
+            valid_size += len(line)
+    return payloads, valid_size, n_invalid
+
+
+def repair_log(filename="dati_ISS_complessivi"):
+    """repair_log(str)
+
+    filename: name of the dataset
+    return: removes the last line of the log if it was left half-written
+    by a crash. Raises ValueError if an invalid line is followed by other
+    lines: the entries after it would be lost"""
+
+    log_file = store_log_path(filename)
+    if not path.exists(log_file):
+        return
+    payloads, valid_size, n_invalid = scan_log(log_file)
+    if n_invalid > 1:
+        raise ValueError(f"{log_file}: line {len(payloads) + 1} is corrupted "
+                         f"and followed by {n_invalid - 1} lines, fix it by hand")
+    if n_invalid == 1:
+        print(f"\n{log_file}: removing the half-written last line")
+        with open(log_file, "r+b") as f:
+            f.truncate(valid_size)
+
+
+def append_to_log(df_0, df_1, filename="dati_ISS_complessivi"):
+    """append_to_log(df, df, str)
+
+    df_0: new epidemiological rows
+    df_1: new populations rows
+    filename: name of the dataset
+    return: appends the rows to the log, as a single checksummed line
+    (the log is repaired first, see repair_log)"""
+
+    log_file = store_log_path(filename)
+    repair_log(filename)
+
+    payload = {"epid": frame_to_payload(df_0), "pop": frame_to_payload(df_1)}
+    entry = {"sha256": payload_checksum(payload), "payload": payload}
+    with open(log_file, "a", encoding="utf-8") as f:
+        f.write(json.dumps(entry, default=int) + "\n")
+        f.flush()
+        fsync(f.fileno())
+
+
+def read_log(filename="dati_ISS_complessivi"):
+    """read_log(str) -> list
+
+    filename: name of the dataset
+    return: list of (epidemiological, populations) new rows.
+    The log ends at the first incomplete or corrupted line,
+    e.g. a line left half-written by a crash"""
+
+    log_file = store_log_path(filename)
+    if not path.exists(log_file):
+        return []
+
+    payloads, _, n_invalid = scan_log(log_file)
+    if n_invalid:
+        print(f"\n{log_file}: line {len(payloads) + 1} is corrupted, "
+              "ignoring the rest of the log")
+    return [(payload_to_frame(payload["epid"]), payload_to_frame(payload["pop"]))
+            for payload in payloads]
+
+
+def upsert_rows(sel_df, new_df):
+    """upsert_rows(df, df) -> df
+
+    sel_df: dataframe indexed by date, from the most recent
+    new_df: rows to insert, replacing all the rows of the same dates
+    return: updated dataframe, from the most recent"""
+
+    new_df = new_df.sort_index(ascending=False, kind="stable")
+    sel_df = sel_df[~sel_df.index.isin(new_df.index.unique())]
+    # The usual case: a new report on top, no need to sort
+    if sel_df.empty or new_df.index.min() > sel_df.index.max():
+        return pd.concat((new_df, sel_df))
+    return pd.concat((new_df, sel_df)).sort_index(ascending=False, kind="stable")
+
+
+def read_xlsx_data(filename):
+    """read_xlsx_data(str) -> df, df
+
+    filename: name of the xlsx
+    return: epidemiological and populations dataframes
+    (used only when the parquet store is not available)"""
+
+    df_xlsx = pd.read_excel(filename, sheet_name=None,
+                            index_col="data", parse_dates=["data"])
+    return df_xlsx["dati epidemiologici"], df_xlsx["popolazioni"]
+
+
+def has_store(filename="dati_ISS_complessivi"):
+    """has_store(str) -> boolean
+
+    filename: name of the dataset
+    return: True if all the parquet files of the dataset exist"""
+
+    return all(path.exists(store_path) for store_path in store_paths(filename))
+
+
+def read_parquet_store(filename="dati_ISS_complessivi"):
+    """read_parquet_store(str) -> df, df
+
+    filename: name of the dataset
+    return: epidemiological and populations dataframes of the parquet
+    files, without the rows of the log"""
+
+    dfs = []
+    for store_path in store_paths(filename):
+        table = pq.read_table(store_path)
+        version = table.schema.metadata.get(b"schema_version", b"").decode()
+        if version != STORE_SCHEMA_VERSION:
+            raise ValueError(f"{store_path}: unsupported schema version {version!r}")
+        sel_df = table.to_pandas()
+        if "età" in sel_df.index.names:
+            sel_df = sel_df.reset_index("età")
+        dfs.append(sel_df)
+    return tuple(dfs)
+
+
+def read_store(filename="dati_ISS_complessivi"):
+    """read_store(str) -> df, df
+
+    filename: name of the dataset
+    return: epidemiological and populations dataframes,
+    including the rows of the log.
+    The xlsx are read if the store is not available yet"""
+
+    if has_store(filename):
+        df_0, df_1 = read_parquet_store(filename)
+    else:
+        df_0, df_1 = read_xlsx_data(f"{filename}.xlsx")
+
+    # Replay the new rows, in order
+    for new_0, new_1 in read_log(filename):
+        df_0 = upsert_rows(df_0, new_0)
+        df_1 = upsert_rows(df_1, new_1)
+    return df_0, df_1
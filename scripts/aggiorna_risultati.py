@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+""" Aggiorna tutti i risultati in un unico processo.
+
+I dati condivisi (store ISS, tassi standardizzati, JHU, OWID, Protezione
+Civile) vengono caricati una sola volta e passati a ciascuno script.
+Ogni script dichiara i propri input: se le impronte (hash) degli input e
+del codice non sono cambiate dall'ultima esecuzione e i grafici esistono,
+lo script viene saltato.
+Se un dataset non è disponibile o la preparazione di uno script fallisce,
+vengono segnalati come falliti solo gli script interessati.
+I grafici sono indipendenti una volta preparati i dati: vengono generati
+in parallelo da un pool di processi (backend Agg), ciascuno partendo
+dallo stesso stile, così il risultato non dipende dal numero di processi. """
+import argparse
+import hashlib
+import json
+import locale
+import multiprocessing as mp
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date
+from glob import glob
+from os import chdir, cpu_count, path, replace
+from time import perf_counter
+
+import matplotlib as mpl
+import matplotlib.pyplot as plt
+import pandas as pd
+
+import andamento_epidemia
+import andamento_rapporti_incidenze
+import confronti_europei
+import confronti_europei_map
+import confronto_2020_2021
+import efficacia_vaccini
+from custom.plots_confronti import import_epidem_data, import_vaccines_data
+from custom.preprocessing_dataframe import compute_incidence_std, read_dati_iss
+
+# impronte dell'ultima esecuzione, salvate insieme ai grafici
+FINGERPRINTS_FILE = path.join("..", "risultati", "fingerprints.json")
+
+# input dichiarati -> chiave dei dati condivisi (vedi load_context)
+INPUT_DATI = {"dati ISS": "dati_iss", "dati ISS età": "dati_iss_età",
+              "tassi std": "tassi_std", "DPC": "dpc",
+              "JHU": "epidem_data", "OWID": "vaccines_data"}
+
+# (nome, script, input dichiarati, grafici generati)
+stages = [("andamento_epidemia", andamento_epidemia,
+           ["dati ISS", "tassi std"],
+           ["andamento_epidemia.png", "andamento_epidemia_std.png",
+            "rapporto_tra_tassi.png", "rapporto_tra_tassi_std.png",
+            "andamento_epidemia_num_assoluti.png",
+            "andamento_epidemia_riassunto.png",
+            "andamento_epidemia_riassunto_std.png"]),
+          ("andamento_rapporti_incidenze", andamento_rapporti_incidenze,
+           ["dati ISS", "dati ISS età"],
+           ["andamento_rapporti_incidenze.png",
+            "andamento_fasce_età_casi.png",
+            "andamento_fasce_età_ospedalizzati.png",
+            "andamento_fasce_età_ricoveratiTI.png",
+            "andamento_fasce_età_decessi.png"]),
+          ("efficacia_vaccini", efficacia_vaccini,
+           ["dati ISS età"],
+           ["tassi_per_età.png", "efficacia_vaccini.png",
+            "tassi_efficacia.png", "focus_over60.png"]),
+          ("confronto_2020_2021", confronto_2020_2021,
+           ["tassi std", "DPC"],
+           ["confrontro_2020_2021.png"]),
+          # la finestra temporale dei confronti europei dipende dalla data
+          ("confronti_europei", confronti_europei,
+           ["JHU", "OWID", "data odierna"],
+           ["confronto_nazioni_epidemia-vaccino.png", "vaccini_decessi_EU.png",
+            "vaccini_decessi_EU_div.png"]),
+          ("confronti_europei_map", confronti_europei_map,
+           ["JHU", "OWID", "shapefile", "data odierna"],
+           ["vaccini_decessi_EU_map.png"])]
+
+
+def timed(name, func, *args):
+    """ Esegue func e stampa il tempo impiegato """
+    start = perf_counter()
+    result = func(*args)
+    print(f"[{name}] {perf_counter() - start:.1f} s")
+    return result
+
+
+def load_context():
+    """ Carica una sola volta i dati condivisi dagli script.
+    Un dataset non disponibile (es. sorgente remota irraggiungibile)
+    vale None: falliscono solo gli script che lo usano """
+
+    # lo store ISS viene letto una volta e resta in memoria
+    loaders = [("dati_iss", "dati ISS", read_dati_iss),
+               ("dati_iss_età", "dati ISS età", lambda: read_dati_iss("dati_ISS_età")),
+               ("tassi_std", "tassi standardizzati", compute_incidence_std),
+               ("dpc", "dati Protezione Civile", confronto_2020_2021.import_dpc_data),
+               ("epidem_data", "dati JHU", import_epidem_data),
+               ("vaccines_data", "dati Our World in Data", import_vaccines_data)]
+    dati = {}
+    for key, name, loader in loaders:
+        try:
+            dati[key] = timed(name, loader)
+        except Exception as e:
+            print(f"[{name}] errore: {e!r}")
+            dati[key] = None
+    return dati
+
+
+def fingerprint_files(pattern):
+    """ Impronta del contenuto dei file che corrispondono a pattern """
+    sha = hashlib.sha256()
+    for filename in sorted(glob(pattern)):
+        sha.update(path.basename(filename).encode())
+        with open(filename, "rb") as f:
+            sha.update(f.read())
+    return sha.hexdigest()
+
+
+def fingerprint_frames(*dfs):
+    """ Impronta del contenuto dei dataframe """
+    sha = hashlib.sha256()
+    for df in dfs:
+        sha.update(",".join(map(str, df.columns)).encode())
+        sha.update(pd.util.hash_pandas_object(df).to_numpy().tobytes())
+    return sha.hexdigest()
+
+
+def fingerprint_code(module):
+    """ Impronta del codice dello script, dei moduli custom
+    e del lettore dello store (dati/iss_store.py) """
+    sha = hashlib.sha256()
+    moduli = sorted(glob(path.join("custom", "*.py")))
+    for filename in [module.__file__, path.join("..", "dati", "iss_store.py")] + moduli:
+        with open(filename, "rb") as f:
+            sha.update(f.read())
+    return sha.hexdigest()
+
+
+def get_inputs(dati):
+    """ Calcola le impronte degli input dichiarati dagli script
+    (None per i dati non disponibili) """
+    inputs = {}
+    for name, key in INPUT_DATI.items():
+        dfs = dati[key]
+        if dfs is None:
+            inputs[name] = None
+        else:
+            inputs[name] = fingerprint_frames(*(dfs if isinstance(dfs, tuple) else (dfs,)))
+    inputs["shapefile"] = fingerprint_files("data/ne_50m_admin_0_countries.*")
+    inputs["data odierna"] = date.today().isoformat()
+    return inputs
+
+
+def load_fingerprints():
+    if not path.exists(FINGERPRINTS_FILE):
+        return {}
+    with open(FINGERPRINTS_FILE, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_fingerprints(fingerprints):
+    with open(FINGERPRINTS_FILE + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(fingerprints, f, indent=2)
+    replace(FINGERPRINTS_FILE + ".tmp", FINGERPRINTS_FILE)
+
+
+def stage_fingerprint(module, inputs, stage_inputs):
+    """ Impronta di uno script: input dichiarati + codice """
+    stage_inputs = {name: inputs[name] for name in stage_inputs}
+    stage_inputs["codice"] = fingerprint_code(module)
+    return hashlib.sha256(json.dumps(stage_inputs, sort_keys=True).encode()).hexdigest()
+
+
+def render(plot, kwargs, rc):
+    """ Genera un grafico partendo dallo stile rc,
+    restituisce il tempo impiegato """
+    start = perf_counter()
+    with mpl.rc_context(rc):
+        plot(**kwargs)
+    plt.close("all")
+    return perf_counter() - start
+
+
+def render_all(jobs, workers=1):
+    """ Genera i grafici, in parallelo se workers > 1
+    jobs: lista di (nome script, funzione, argomenti, stile)
+    return: nomi degli script con almeno un grafico non generato """
+
+    failed = set()
+    if workers > 1 and "fork" in mp.get_all_start_methods():
+        # i processi figli ereditano i dati già preparati
+        with ProcessPoolExecutor(max_workers=workers,
+                                 mp_context=mp.get_context("fork"),
+                                 initializer=plt.switch_backend,
+                                 initargs=("Agg",)) as executor:
+            futures = {executor.submit(render, plot, kwargs, rc): (name, plot)
+                       for name, plot, kwargs, rc in jobs}
+            for future in as_completed(futures):
+                name, plot = futures[future]
+                try:
+                    print(f"[{name}] {plot.__name__} {future.result():.1f} s")
+                except Exception as e:
+                    print(f"[{name}] {plot.__name__} errore: {e!r}")
+                    failed.add(name)
+    else:
+        for name, plot, kwargs, rc in jobs:
+            try:
+                print(f"[{name}] {plot.__name__} {render(plot, kwargs, rc):.1f} s")
+            except Exception as e:
+                print(f"[{name}] {plot.__name__} errore: {e!r}")
+                failed.add(name)
+    return failed
+
+
+def run_stages(dati, force=False, workers=1):
+    """ Genera i grafici degli script con input modificati
+    force: rigenera tutti i grafici
+    workers: numero di processi usati per generare i grafici
+    return: nomi degli script con errori """
+
+    inputs = get_inputs(dati)
+    fingerprints = load_fingerprints()
+    skipped = []
+    updated = {}
+    jobs = []
+    failed = set()
+    for name, module, stage_inputs, outputs in stages:
+        missing = [input_name for input_name in stage_inputs if inputs[input_name] is None]
+        if missing:
+            print(f"[{name}] dati non disponibili: {', '.join(missing)}")
+            failed.add(name)
+            continue
+
+        fingerprint = stage_fingerprint(module, inputs, stage_inputs)
+        outputs_exist = all(path.exists(path.join("../risultati", output))
+                            for output in outputs)
+        if not force and outputs_exist and fingerprints.get(name) == fingerprint:
+            print(f"[{name}] input invariati, saltato")
+            skipped.append((name, outputs))
+            continue
+
+        # ogni script parte dallo stile di default, come in un nuovo processo
+        try:
+            with plt.style.context("default"):
+                timed(f"{name} (dati)", module.prepare, dati)
+                rc = {key: value for key, value in mpl.rcParams.items()
+                      if key != "backend"}
+            plots = module.get_plots()
+        except Exception as e:
+            print(f"[{name}] errore: {e!r}")
+            failed.add(name)
+            continue
+        jobs.extend((name, plot, kwargs, rc) for plot, kwargs in plots)
+        updated[name] = fingerprint
+
+    failed |= timed("grafici", render_all, jobs, workers)
+
+    # salva le impronte solo degli script completati
+    fingerprints.update({name: fingerprint for name, fingerprint in updated.items()
+                         if name not in failed})
+    save_fingerprints(fingerprints)
+
+    if skipped:
+        n_outputs = sum(len(outputs) for _, outputs in skipped)
+        print(f"\n{n_outputs} grafici non rigenerati:")
+        for name, outputs in skipped:
+            print(f"{name}: {', '.join(outputs)}")
+    return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Aggiorna i risultati")
+    parser.add_argument("--force", action="store_true",
+                        help="rigenera tutti i grafici")
+    parser.add_argument("--workers", type=int, default=cpu_count(),
+                        help="numero di processi per generare i grafici")
+    args = parser.parse_args()
+
+    # Set work directory for the script
+    scriptpath = path.dirname(path.realpath(__file__))
+    chdir(scriptpath)
+
+    # Set locale to "it" to parse the month correctly
+    locale.setlocale(locale.LC_ALL, "it_IT.UTF-8")
+
+    start = perf_counter()
+    dati = timed("caricamento dati", load_context)
+    failed = run_stages(dati, force=args.force, workers=args.workers)
+    print(f"\nTotale: {perf_counter() - start:.1f} s")
+    if failed:
+        sys.exit(f"Errori in: {', '.join(sorted(failed))}")
@@ -29,9 +29,10 @@ def which_axe(axis):
 
 
 # Importa dati
-def load_data():
+def load_data(dati=None):
     """ Importa dati dell'Istituto Superiore di Sanità
-    ricavati dai bollettini settimanali."""
+    ricavati dai bollettini settimanali.
+    dati: contesto con i dati già caricati (opzionale)"""
 
     df_epid, df_pop = get_df_complessivo()
 
@@ -43,7 +44,7 @@ def load_data():
     df_tassi.index = pd.to_datetime(df_epid["data"])
 
     # Ricava i tassi standardizzati per fascia di età
-    df_tassi_std = compute_incidence_std()
+    df_tassi_std = compute_incidence_std() if dati is None else dati["tassi_std"]
 
     # Calcola i numeri assoluti (medi, giornalieri) dell"epidemia
     df_epid = df_epid.copy(deep=True)
@@ -199,6 +200,38 @@ def plot_rapporto_tassi(show=False, is_std=False):
         plt.show()
 
 
+def prepare(dati=None):
+    """ Carica i dati e imposta le variabili usate dai grafici
+    dati: contesto con i dati già caricati (opzionale)"""
+    global df_tassi, df_tassi_std, df_epid, eventi, x_ticks, x_labels
+
+    # Imposta stile grafici
+    apply_plot_treatment()
+
+    df_tassi, df_tassi_std, df_epid, eventi = load_data(dati)
+
+    x_ticks, x_labels = get_xticks_labels(reports_dates=df_epid.index)
+
+
+def get_plots():
+    """ Grafici da generare: (funzione, argomenti) """
+    return [(plot_incidenza, {}),
+            (plot_incidenza, {"is_std": True}),
+            (plot_rapporto_tassi, {}),
+            (plot_rapporto_tassi, {"is_std": True}),
+            (plot_num_assoluti, {}),
+            (plot_riassunto, {}),
+            (plot_riassunto, {"is_std": True})]
+
+
+def main(dati=None):
+    """ Genera i grafici
+    dati: contesto con i dati già caricati (opzionale)"""
+    prepare(dati)
+    for plot, kwargs in get_plots():
+        plot(**kwargs)
+
+
 if __name__ == "__main__":
     # Set work directory for the script
     scriptpath = path.dirname(path.realpath(__file__))
@@ -207,17 +240,4 @@ if __name__ == "__main__":
     # Set locale to "it" to parse the month correctly
     locale.setlocale(locale.LC_ALL, "it_IT.UTF-8")
 
-    # Imposta stile grafici
-    apply_plot_treatment()
-
-    df_tassi, df_tassi_std, df_epid, eventi = load_data()
-
-    x_ticks, x_labels = get_xticks_labels(reports_dates=df_epid.index)
-
-    plot_incidenza()
-    plot_incidenza(is_std=True)
-    plot_rapporto_tassi()
-    plot_rapporto_tassi(is_std=True)
-    plot_num_assoluti()
-    plot_riassunto()
-    plot_riassunto(is_std=True)
+    main()
@@ -9,7 +9,8 @@ import pandas as pd
 
 from custom.plots import (add_title, apply_plot_treatment, get_xticks_labels,
                           palette, set_size)
-from custom.preprocessing_dataframe import compute_incidence
+from custom.preprocessing_dataframe import (compute_incidence_cube,
+                                            read_dati_iss)
 from custom.watermarks import add_last_updated, add_watermark
 
 classi_età = ["12-39", "40-59", "60-79", "80+"]
@@ -19,23 +20,9 @@ classi_età = ["12-39", "40-59", "60-79", "80+"]
 def compute_incidence_ratio(category):
     """ Calcolo rapporti incidenze per età """
 
-    result_list = []
-
-    for date in np.flip(date_reports):
-        df_epid = df_età_epid.loc[date]
-        df_pop = df_età_pop.loc[date]
-        df_tassi, _ = compute_incidence(df_epid, df_pop)
-
-        r_casi = df_tassi["casi non vaccinati"]/(df_tassi["casi non vaccinati"] + df_tassi["casi vaccinati completo"])*100
-        r_osp = df_tassi["ospedalizzati non vaccinati"]/(df_tassi["ospedalizzati non vaccinati"] + df_tassi["ospedalizzati vaccinati completo"])*100
-        r_ti = df_tassi["terapia intensiva non vaccinati"]/(df_tassi["terapia intensiva non vaccinati"] + df_tassi["terapia intensiva vaccinati completo"])*100
-        r_dec = df_tassi["decessi non vaccinati"]/(df_tassi["decessi non vaccinati"] + df_tassi["decessi vaccinati completo"])*100
-        rapporto_fra_tassi = pd.DataFrame(np.transpose([r_casi, r_osp, r_ti, r_dec]))
-        rapporto_fra_tassi.columns = ["Casi", "Ospedalizzati", "TI", "Deceduti"]
-        rapporto_fra_tassi.index = df_tassi.index
-        result_list.append(np.array(rapporto_fra_tassi[category]))
-
-    return np.array(result_list)
+    # una riga per data (dalla meno recente), una colonna per fascia d'età
+    df_ratio = df_cube["rapporto", category].unstack("età")
+    return df_ratio.loc[np.flip(date_reports), classi_età].to_numpy()
 
 
 def add_to_plot(ax):
@@ -101,47 +88,17 @@ def ricava_andamenti_età(età, colonna, incidenza_mensile):
     """Ricava andamento delle varie incindenze nel tempo,
     divise per fascia d"età e categoria"""
 
-    # loop around the reports
-    results_date = []
-    for data in date_reports:
-        df = df_età_epid.loc[data]
-        df = df[df["età"] == età]
-
-        non_vacc_labels = ["casi non vaccinati",
-                           "ospedalizzati non vaccinati",
-                           "terapia intensiva non vaccinati",
-                           "decessi non vaccinati"]
-
-        vacc_labels = ["casi vaccinati completo", "ospedalizzati vaccinati completo",
-                       "terapia intensiva vaccinati completo", "decessi vaccinati completo"]
-
-        if incidenza_mensile is True:
-            # calcola incidenza mensile ogni
-            # 100.000 abitanti per ciascun gruppo
-            df_pop = df_età_pop.loc[data]
-            df_pop = df_pop[df_pop["età"] == età]
-            non_vacc_den_labels = ["casi non vaccinati", "ospedalizzati/ti non vaccinati",
-                                   "ospedalizzati/ti non vaccinati", "decessi non vaccinati"]
-            vacc_den_labels = ["casi vaccinati completo", "ospedalizzati/ti vaccinati completo",
-                               "ospedalizzati/ti vaccinati completo", "decessi vaccinati completo"]
-            df[non_vacc_labels] = df[non_vacc_labels]/df_pop[non_vacc_den_labels].values[0]*10**5
-            df[vacc_labels] = df[vacc_labels]/df_pop[vacc_den_labels].values[0]*10**5
-        else:
-            # converti in numeri giornalieri, media mobile 30 giorni
-            df[colonna] = df[colonna]/30
-
-        result_single_date = [data, np.array(df[colonna])[0]]
-        results_date.append(result_single_date)
-
-    df_results = pd.DataFrame(results_date)
-
     if incidenza_mensile is True:
-        df_results.columns = ["date", "incidenza "+str(colonna)+", "+str(età)]
+        # incidenza mensile ogni 100.000 abitanti per ciascun gruppo
+        df_results = df_cube["incidenza", colonna].xs(età, level="età")
+        label = "incidenza "+str(colonna)+", "+str(età)
     else:
-        df_results.columns = ["date", str(colonna)+", "+str(età)]
+        # numeri giornalieri, media mobile 30 giorni
+        df_results = df_cube["giornalieri", colonna].xs(età, level="età")
+        label = str(colonna)+", "+str(età)
 
-    df_results.index = pd.to_datetime(df_results["date"])
-    df_results = df_results.drop("date", axis=1)
+    df_results = df_results.loc[date_reports].to_frame(label)
+    df_results.index = pd.to_datetime(df_results.index).rename("date")
     return df_results
 
 
@@ -184,13 +141,11 @@ def plot_assoluti_incidenza_età(categorie, titoli, filename, show=False):
         plt.show()
 
 
-if __name__ == "__main__":
-    # Set work directory for the script
-    scriptpath = path.dirname(path.realpath(__file__))
-    chdir(scriptpath)
-
-    # Set locale to "it" to parse the month correctly
-    locale.setlocale(locale.LC_ALL, "it_IT.UTF-8")
+def prepare(dati=None):
+    """ Carica i dati e imposta le variabili usate dai grafici
+    dati: contesto con i dati già caricati (opzionale)"""
+    global shared_legend, df_cube, date_reports, incidenza_casi, \
+        ratio_x_ticks, ratio_x_labels, x_ticks, x_labels
 
     # Imposta stile grafici
     apply_plot_treatment()
@@ -201,10 +156,7 @@ if __name__ == "__main__":
                      "60-79 vaccinati", "80+ vaccinati"]
 
     # Recupera dati età
-    df_età = pd.read_excel("../dati/dati_ISS_età.xlsx", sheet_name=None,
-                           index_col="data", parse_dates=["data"])
-    df_età_epid = df_età["dati epidemiologici"]
-    df_età_pop = df_età["popolazioni"]
+    df_età_epid, df_età_pop = read_dati_iss("dati_ISS_età")
 
     # Filtra fascia 5-11
     df_età_epid = df_età_epid[df_età_epid["età"] != "5-11"]
@@ -214,38 +166,63 @@ if __name__ == "__main__":
     df_pop = df_età_pop[df_età_pop.index > "2021-07-28"]
     date_reports = df_epid.index.unique()
 
+    # incidenze e rapporti per ogni data e fascia d'età
+    df_cube = compute_incidence_cube(df_epid, df_pop)
+
     ratio_x_ticks, ratio_x_labels = get_xticks_labels(full=True)
 
     incidenza_casi = compute_incidence_ratio("Casi")
 
-    plot_rapporti_incidenze()
-
     x_ticks, x_labels = get_xticks_labels()
 
+
+def get_plots():
+    """ Grafici da generare: (funzione, argomenti) """
     titolo_0 = "%s giornalieri (media 30 giorni)"
     titolo_1 = "Incidenza %s per 100.000"
     nome_file = "../risultati/andamento_fasce_età_%s.png"
 
-    # casi
-    plot_assoluti_incidenza_età(categorie=["casi non vaccinati", "casi vaccinati completo"],
-                                titoli=[titolo_0 % "Casi",
-                                        titolo_1 % "nuovi casi"],
-                                filename=nome_file % "casi")
-
-    # ospedalizzazioni
-    plot_assoluti_incidenza_età(categorie=["ospedalizzati non vaccinati", "ospedalizzati vaccinati completo"],
-                                titoli=[titolo_0 % "Ospedalizzati",
-                                        titolo_1 % "ospedalizzazioni"],
-                                filename=nome_file % "ospedalizzati")
-
-    # in terapia intensiva
-    plot_assoluti_incidenza_età(categorie=["terapia intensiva non vaccinati", "terapia intensiva vaccinati completo"],
-                                titoli=[titolo_0 % "Ricoverati in TI",
-                                        titolo_1 % "ingressi in TI"],
-                                filename=nome_file % "ricoveratiTI")
-
-    # decessi
-    plot_assoluti_incidenza_età(categorie=["decessi non vaccinati", "decessi vaccinati completo"],
-                                titoli=[titolo_0 % "Decessi",
-                                        titolo_1 % "decessi"],
-                                filename=nome_file % "decessi")
+    return [(plot_rapporti_incidenze, {}),
+            # casi
+            (plot_assoluti_incidenza_età,
+             dict(categorie=["casi non vaccinati", "casi vaccinati completo"],
+                  titoli=[titolo_0 % "Casi",
+                          titolo_1 % "nuovi casi"],
+                  filename=nome_file % "casi")),
+            # ospedalizzazioni
+            (plot_assoluti_incidenza_età,
+             dict(categorie=["ospedalizzati non vaccinati", "ospedalizzati vaccinati completo"],
+                  titoli=[titolo_0 % "Ospedalizzati",
+                          titolo_1 % "ospedalizzazioni"],
+                  filename=nome_file % "ospedalizzati")),
+            # in terapia intensiva
+            (plot_assoluti_incidenza_età,
+             dict(categorie=["terapia intensiva non vaccinati", "terapia intensiva vaccinati completo"],
+                  titoli=[titolo_0 % "Ricoverati in TI",
+                          titolo_1 % "ingressi in TI"],
+                  filename=nome_file % "ricoveratiTI")),
+            # decessi
+            (plot_assoluti_incidenza_età,
+             dict(categorie=["decessi non vaccinati", "decessi vaccinati completo"],
+                  titoli=[titolo_0 % "Decessi",
+                          titolo_1 % "decessi"],
+                  filename=nome_file % "decessi"))]
+
+
+def main(dati=None):
+    """ Genera i grafici
+    dati: contesto con i dati già caricati (opzionale)"""
+    prepare(dati)
+    for plot, kwargs in get_plots():
+        plot(**kwargs)
+
+
+if __name__ == "__main__":
+    # Set work directory for the script
+    scriptpath = path.dirname(path.realpath(__file__))
+    chdir(scriptpath)
+
+    # Set locale to "it" to parse the month correctly
+    locale.setlocale(locale.LC_ALL, "it_IT.UTF-8")
+
+    main()
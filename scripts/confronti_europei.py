@@ -261,17 +261,18 @@ def plot_corr_vaccini_decessi_div(show=False):
         plt.show()
 
 
-if __name__ == "__main__":
-    # Set work directory for the script
-    scriptpath = path.dirname(path.realpath(__file__))
-    chdir(scriptpath)
-
-    # Set locale to "it" to parse the month correctly
-    locale.setlocale(locale.LC_ALL, "it_IT.UTF-8")
+def prepare(dati=None):
+    """ Carica i dati e imposta le variabili usate dai grafici
+    dati: contesto con i dati già caricati (opzionale)"""
+    global df_confirmed, df_deaths, df_recovered, df_vacc, vacc_res, dec_res, df_
 
     # importa dati
-    df_confirmed, df_deaths, df_recovered = import_epidem_data()
-    df_vacc = import_vaccines_data()
+    if dati is None:
+        df_confirmed, df_deaths, df_recovered = import_epidem_data()
+        df_vacc = import_vaccines_data()
+    else:
+        df_confirmed, df_deaths, df_recovered = dati["epidem_data"]
+        df_vacc = dati["vaccines_data"]
 
     # recupera dati vaccini vs. decessi
     # da inizio autunno (22 settembre 2021)
@@ -284,14 +285,35 @@ if __name__ == "__main__":
     # Imposta stile grafici
     apply_plot_treatment()
 
-    # plot dati selezione paesi
-    plot_selection()
-
     # ordina valori in un df per far si che seguano la sequenza dei colori
     df_ = pd.DataFrame({"% vaccini": vacc_res, "decessi": dec_res})
     df_.index = paesi_eu_ita
     df_ = df_.sort_values(by="% vaccini")
 
-    # plot correlazione vaccini vs. decessi per paesi eu dal 1° settembre 2021
-    plot_corr_vaccini_decessi()
-    plot_corr_vaccini_decessi_div()
+
+def get_plots():
+    """ Grafici da generare: (funzione, argomenti) """
+    # plot dati selezione paesi e correlazione vaccini vs. decessi
+    # per paesi eu dal 1° settembre 2021
+    return [(plot_selection, {}),
+            (plot_corr_vaccini_decessi, {}),
+            (plot_corr_vaccini_decessi_div, {})]
+
+
+def main(dati=None):
+    """ Genera i grafici
+    dati: contesto con i dati già caricati (opzionale)"""
+    prepare(dati)
+    for plot, kwargs in get_plots():
+        plot(**kwargs)
+
+
+if __name__ == "__main__":
+    # Set work directory for the script
+    scriptpath = path.dirname(path.realpath(__file__))
+    chdir(scriptpath)
+
+    # Set locale to "it" to parse the month correctly
+    locale.setlocale(locale.LC_ALL, "it_IT.UTF-8")
+
+    main()
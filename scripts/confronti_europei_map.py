@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
+import hashlib
+import json
+import pickle
 import warnings
 from datetime import date, datetime
-from os import chdir, path
+from os import chdir, getpid, makedirs, path, replace
 from string import ascii_lowercase
 
 import geopandas as gpd
@@ -25,58 +28,173 @@ from custom.plots_confronti import (compute_vaccini_decessi_eu, fit_model,
                                     import_epidem_data, import_vaccines_data,
                                     paesi_abitanti_eu)
 
+SHAPEFILE = "data/ne_50m_admin_0_countries"
+MAP_CACHE_DIR = path.join("cache", "maps")
+
+# Albers Equal Area centrata sull'Europa,
+# senza coste (resolution=None): i confini vengono dallo shapefile
+PROJECTION = dict(resolution=None, projection="aea", width=5000000, height=4500000,
+                  lat_1=45, lat_2=60, lon_0=16, lat_0=53)
+
+# Output size of the map
+MAP_FIGSIZE = (14, 14)
+MAP_DPI = 300
+
 
 def get_map_labels(countries_df, extent_polygon, basemap_map, adm0_a3_it):
     """ Get map labels """
 
     map_labels = []
-    countries_df_clip = gpd.clip(countries_df, extent_polygon)
-    for _, row in countries_df_clip.iterrows():
-        if row["ADM0_A3_IT"] in adm0_a3_it.values():
-            label_ctx = row["geometry"].representative_point()
-            label_ctx = basemap_map(label_ctx.x, label_ctx.y)
-            labelx, labely = label_ctx[0], label_ctx[1]
-            if row["ADM0_A3_IT"] == "LUX":
-                labelx, labely = labelx + 100000, labely
-            if row["ADM0_A3_IT"] == "CYP":
-                labelx, labely = labelx, labely - 110000
-            if row["ADM0_A3_IT"] == "MLT":
-                labelx, labely = labelx, labely - 55000
-            map_labels.append((row["ADM0_A3_IT"], (labelx, labely)))
+    eu_df = countries_df[countries_df["ADM0_A3_IT"].isin(adm0_a3_it.values())]
+    for code, geom in zip(eu_df["ADM0_A3_IT"], eu_df["geometry"]):
+        # Clip only the EU countries to the Europe extent
+        label_ctx = geom.intersection(extent_polygon).representative_point()
+        label_ctx = basemap_map(label_ctx.x, label_ctx.y)
+        labelx, labely = label_ctx[0], label_ctx[1]
+        if code == "LUX":
+            labelx, labely = labelx + 100000, labely
+        if code == "CYP":
+            labelx, labely = labelx, labely - 110000
+        if code == "MLT":
+            labelx, labely = labelx, labely - 55000
+        map_labels.append((code, (labelx, labely)))
     return map_labels
 
 
-def get_eu_patches(eu_countries, basemap_map):
+def get_map_bbox(basemap_map, n_points=100, margin=1):
+    """ Lon/lat bounding box of the map frame
+
+    The frame of the conic projection covers more than the Europe
+    extent (e.g. lon -40..72 at the top corners), so the box is
+    computed from the inverse projection of the frame edges """
+    xs = np.linspace(basemap_map.llcrnrx, basemap_map.urcrnrx, n_points)
+    ys = np.linspace(basemap_map.llcrnry, basemap_map.urcrnry, n_points)
+    frame_x = np.concatenate([xs, xs, np.full(n_points, xs[0]), np.full(n_points, xs[-1])])
+    frame_y = np.concatenate([np.full(n_points, ys[0]), np.full(n_points, ys[-1]), ys, ys])
+    lons, lats = basemap_map(frame_x, frame_y, inverse=True)
+    return (round(float(lons.min()) - margin, 2), round(float(lats.min()) - margin, 2),
+            round(float(lons.max()) + margin, 2), round(float(lats.max()) + margin, 2))
+
+
+def project_rings(countries_df, basemap_map):
+    """ Project the exterior rings of all the countries at once
+    return: dictionary ADM0_A3_IT -> list of projected rings (n x 2 arrays)"""
+    codes = []
+    rings = []
+    for code, geom in zip(countries_df["ADM0_A3_IT"], countries_df["geometry"]):
+        parts = geom.geoms if geom.geom_type == "MultiPolygon" else [geom]
+        for part in parts:
+            codes.append(code)
+            rings.append(np.asarray(part.exterior.coords)[:, :2])
+
+    # One projection call for all the vertices
+    lons, lats = np.concatenate(rings).T
+    x_proj, y_proj = basemap_map(lons, lats)
+    projected = np.split(np.column_stack([x_proj, y_proj]),
+                         np.cumsum([len(ring) for ring in rings])[:-1])
+
+    countries_rings = {}
+    for code, ring in zip(codes, projected):
+        countries_rings.setdefault(code, []).append(ring)
+    return countries_rings
+
+
+def get_tolerance(basemap_map, figsize=MAP_FIGSIZE, dpi=MAP_DPI):
+    """ Simplification tolerance: half of the output pixel size, in map units
+
+    The map is narrower than the figure, so the figure width
+    gives a conservative (smaller) pixel size """
+    map_width = basemap_map.urcrnrx - basemap_map.llcrnrx
+    return map_width / (figsize[0] * dpi) / 2
+
+
+def simplify_rings(countries_rings, tolerance):
+    """ Simplify the projected rings, details below the tolerance are not visible """
+    simplified_rings = {}
+    for code, rings in countries_rings.items():
+        simplified_rings[code] = [np.asarray(ShapPolygon(ring)
+                                             .simplify(tolerance, preserve_topology=True)
+                                             .exterior.coords)
+                                  for ring in rings]
+    return simplified_rings
+
+
+def get_fade_path(countries_rings, eu_codes, map_extent_polygon):
+    """ Fade mask: the map (plus a margin) outside the EU countries """
+    eu_union = unary_union([ShapPolygon(ring)
+                            for code in eu_codes
+                            for ring in countries_rings[code]])
+    return pathify(map_extent_polygon.buffer(100000).difference(eu_union)[0])
+
+
+def map_cache_key(*params):
+    """ Cache key: shapefile version and content + parameters """
+    sha = hashlib.sha256()
+    for ext in [".VERSION.txt", ".shp", ".dbf"]:
+        with open(SHAPEFILE + ext, "rb") as f:
+            sha.update(f.read())
+    sha.update(json.dumps(params, sort_keys=True).encode())
+    return sha.hexdigest()[:24]
+
+
+def load_map_geometries(basemap_map, extent_polygon):
+    """ Get projected and simplified country rings, map labels
+    and fade mask, from the disk cache if available """
+
+    map_bbox = get_map_bbox(basemap_map)
+    tolerance = get_tolerance(basemap_map)
+    key = map_cache_key(PROJECTION, adm0_a3_it, map_bbox, tolerance)
+    cache_file = path.join(MAP_CACHE_DIR, f"geometries_{key}.pkl")
+    if path.exists(cache_file):
+        with open(cache_file, "rb") as f:
+            return pickle.load(f)
+
+    # Open 50m World Countries from natural earth,
+    # only the countries visible in the map and the needed column
+    countries_df = gpd.read_file(SHAPEFILE + ".shp", bbox=map_bbox,
+                                 include_fields=["ADM0_A3_IT"])
+
+    # Get borders recognized by Italy
+    countries_df = countries_df.dissolve(by="ADM0_A3_IT", aggfunc="last").reset_index()
+
+    countries_rings = simplify_rings(project_rings(countries_df, basemap_map), tolerance)
+
+    # Map boundary
+    map_extent_polygon = ShapPolygon([(basemap_map.llcrnrx, basemap_map.llcrnry),
+                                      (basemap_map.urcrnrx, basemap_map.llcrnry),
+                                      (basemap_map.urcrnrx, basemap_map.urcrnry),
+                                      (basemap_map.llcrnrx, basemap_map.urcrnry),
+                                      (basemap_map.llcrnrx, basemap_map.llcrnry)])
+
+    geometries = (countries_rings,
+                  get_map_labels(countries_df, extent_polygon, basemap_map, adm0_a3_it),
+                  get_fade_path(countries_rings, adm0_a3_it.values(), map_extent_polygon))
+
+    makedirs(MAP_CACHE_DIR, exist_ok=True)
+    tmp_file = f"{cache_file}.{getpid()}.tmp"
+    with open(tmp_file, "wb") as f:
+        pickle.dump(geometries, f)
+    replace(tmp_file, cache_file)
+    return geometries
+
+
+def get_eu_patches(eu_countries, countries_rings):
     """ Get EU-27 patches"""
     eu_patches = []
     eu_colors = []
-    for _, row in eu_countries.iterrows():
-        geom = row["geometry"]
-        if geom.geom_type == "MultiPolygon":
-            for part in geom:
-                coords = np.array([basemap_map(cd[0], cd[1]) for cd in part.exterior.coords[:]])
-                eu_patches.append(MpPolygon(coords, True))
-                eu_colors.append(row["Biv_color"])
-        else:
-            coords = np.array([basemap_map(cd[0], cd[1]) for cd in geom.exterior.coords[:]])
-            eu_patches.append(MpPolygon(coords, True))
-            eu_colors.append(row["Biv_color"])
+    for code, color in zip(eu_countries["ADM0_A3_IT"], eu_countries["Biv_color"]):
+        for ring in countries_rings[code]:
+            eu_patches.append(MpPolygon(ring, True))
+            eu_colors.append(color)
     return eu_patches, eu_colors
 
 
-def get_wld_patches(countries_df, eu_countries, basemap_map):
+def get_wld_patches(countries_rings, eu_countries):
     """ Get world patches"""
     wld_patches = []
-    for _, row in countries_df.iterrows():
-        if row["ADM0_A3_IT"] not in eu_countries["ADM0_A3_IT"]:
-            geom = row["geometry"]
-            if geom.geom_type == "MultiPolygon":
-                for part in geom:
-                    coords = np.array([basemap_map(c[0], c[1]) for c in part.exterior.coords[:]])
-                    wld_patches.append(MpPolygon(coords, True))
-            else:
-                coords = np.array([basemap_map(c[0], c[1]) for c in geom.exterior.coords[:]])
-                wld_patches.append(MpPolygon(coords, True))
+    for code, rings in countries_rings.items():
+        if code not in eu_countries["ADM0_A3_IT"].values:
+            wld_patches.extend(MpPolygon(ring, True) for ring in rings)
     return wld_patches
 
 
@@ -143,15 +261,8 @@ def plot_map_corr_vaccini_decessi(show=False):
     # Add country abbreviation column
     vacc_dec_2021["ADM0_A3_IT"] = vacc_dec_2021.apply(lambda row: adm0_a3_it[row["Country"]], axis=1)
 
-    # Open 50m World Countries from natural earth
-    countries_df = gpd.read_file("data/ne_50m_admin_0_countries.shp")
-
-    # Get borders recognized by Italy
-    countries_df = countries_df.dissolve(by="ADM0_A3_IT", aggfunc="last").reset_index()
-
     # Get European countries
-    eu_countries = pd.merge(countries_df, vacc_dec_2021, left_on="ADM0_A3_IT",
-                            right_on="ADM0_A3_IT")[["ADM0_A3_IT", "Country", "Vax", "Dth", "geometry"]]
+    eu_countries = vacc_dec_2021.sort_values("ADM0_A3_IT").reset_index(drop=True)
 
     # Create the bivariate classes
     eu_countries["Dth_class"] = eu_countries[["Dth"]].apply(map_classifier).astype(str)
@@ -160,7 +271,7 @@ def plot_map_corr_vaccini_decessi(show=False):
     eu_countries["Biv_class"] = eu_countries["Vax_class_lett"].str.cat(eu_countries["Dth_class"])
     eu_countries["Biv_color"] = eu_countries.apply(lambda row: output_map_colors[row["Biv_class"]], axis=1)
 
-    fig = plt.figure(figsize=(14, 14))
+    fig = plt.figure(figsize=MAP_FIGSIZE)
     ax = plt.subplot(111)
 
     # Remove white margins
@@ -168,8 +279,7 @@ def plot_map_corr_vaccini_decessi(show=False):
     ax.margins(0)
 
     # Create a map, set projection to aea
-    basemap_map = Basemap(resolution="l", projection="aea", width=5000000, height=4500000,
-                          lat_1=45, lat_2=60, lon_0=16, lat_0=53)
+    basemap_map = Basemap(**PROJECTION)
 
     # Draw parallels and meridians
     dashes = [5, 7]
@@ -182,22 +292,14 @@ def plot_map_corr_vaccini_decessi(show=False):
                               linewidth=0.5,
                               color="grey")
 
-    # Map boundary
-    xx_min, xx_max = ax.get_xbound()
-    yy_min, yy_max = ax.get_ybound()
-    map_extent_polygon = ShapPolygon([(xx_min, yy_min),
-                                      (xx_max, yy_min),
-                                      (xx_max, yy_max),
-                                      (xx_min, yy_max),
-                                      (xx_min, yy_min)])
+    # Get projected countries, map labels and fade mask
+    countries_rings, map_labels, fade_path = load_map_geometries(basemap_map, extent_polygon)
+
     # Get EU-Countries patches
-    eu_patches, eu_colors = get_eu_patches(eu_countries, basemap_map)
+    eu_patches, eu_colors = get_eu_patches(eu_countries, countries_rings)
 
     # Get World-Countries patches
-    wld_patches = get_wld_patches(countries_df, eu_countries, basemap_map)
-
-    # Get map labels
-    map_labels = get_map_labels(countries_df, extent_polygon, basemap_map, adm0_a3_it)
+    wld_patches = get_wld_patches(countries_rings, eu_countries)
 
     # Add World countries
     ax.add_collection(PatchCollection(wld_patches,
@@ -212,10 +314,6 @@ def plot_map_corr_vaccini_decessi(show=False):
                                       linewidths=0.6))
 
     # Fade effect
-    eu_patches_union = unary_union([ShapPolygon(eu_patch.xy)
-                                   for eu_patch in eu_patches])
-
-    fade_path = pathify(map_extent_polygon.buffer(100000).difference(eu_patches_union)[0])
     fade_patch = PathPatch(fade_path, facecolor='white', alpha=0.6)
     ax.add_patch(fade_patch)
 
@@ -394,7 +492,7 @@ def plot_map_corr_vaccini_decessi(show=False):
 
     # Save the map
     fig.savefig("../risultati/vaccini_decessi_EU_map.png",
-                dpi=300,
+                dpi=MAP_DPI,
                 bbox_inches="tight",
                 pad_inches=0,
                 facecolor=ocean_color)
@@ -402,10 +500,10 @@ def plot_map_corr_vaccini_decessi(show=False):
         plt.show()
 
 
-if __name__ == "__main__":
-    # Set work directory for the script
-    scriptpath = path.dirname(path.realpath(__file__))
-    chdir(scriptpath)
+def prepare(dati=None):
+    """ Carica i dati e imposta le variabili usate dai grafici
+    dati: contesto con i dati già caricati (opzionale)"""
+    global adm0_a3_it, vacc_res, dec_res
 
     adm0_a3_it = {"Austria": "AUT", "Belgium": "BEL", "Bulgaria": "BGR", "Cyprus": "CYP",
                   "Croatia": "HRV", "Denmark": "DNK", "Estonia": "EST", "Finland": "FIN",
@@ -416,8 +514,12 @@ if __name__ == "__main__":
                   "Spain": "ESP", "Sweden": "SWE", "Hungary": "HUN"}
 
     # importa dati
-    _, df_deaths, _ = import_epidem_data()
-    df_vacc = import_vaccines_data()
+    if dati is None:
+        _, df_deaths, _ = import_epidem_data()
+        df_vacc = import_vaccines_data()
+    else:
+        _, df_deaths, _ = dati["epidem_data"]
+        df_vacc = dati["vaccines_data"]
 
     # recupera dati vaccini vs. decessi
     # da inizio autunno (22 settembre 2021)
@@ -427,5 +529,24 @@ if __name__ == "__main__":
     vacc_res, dec_res = compute_vaccini_decessi_eu(df_vacc, df_deaths,
                                                    window, fully=False)
 
+
+def get_plots():
+    """ Grafici da generare: (funzione, argomenti) """
     # plot mappa bivariata
-    plot_map_corr_vaccini_decessi()
+    return [(plot_map_corr_vaccini_decessi, {})]
+
+
+def main(dati=None):
+    """ Genera i grafici
+    dati: contesto con i dati già caricati (opzionale)"""
+    prepare(dati)
+    for plot, kwargs in get_plots():
+        plot(**kwargs)
+
+
+if __name__ == "__main__":
+    # Set work directory for the script
+    scriptpath = path.dirname(path.realpath(__file__))
+    chdir(scriptpath)
+
+    main()
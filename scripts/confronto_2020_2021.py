@@ -9,6 +9,7 @@ import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 
+from custom.datasets import read_remote_csv
 from custom.plots import (add_suptitle, add_title, apply_plot_treatment,
                           palette, set_size)
 from custom.preprocessing_dataframe import (compute_incidence_std,
@@ -17,14 +18,25 @@ from custom.watermarks import add_last_updated, add_watermark
 
 
 # Importa dati
-def import_data():
-    """ Imposta dati ISS e Protezione Civile """
+def import_dpc_data():
+    """ Importa dati nazionali sui contagi della Protezione Civile """
 
-    # Dati nazionali sui contagi
     url = "https://github.com/pcm-dpc/COVID-19/raw/master/dati-andamento-nazionale/dpc-covid19-ita-andamento-nazionale.csv"
-    df_IT = pd.read_csv(url,
-                        parse_dates=["data"],
-                        index_col="data")
+    df_IT = read_remote_csv(url,
+                            parse_dates=["data"],
+                            index_col="data")
+    return df_IT
+
+
+def import_data(dati=None):
+    """ Imposta dati ISS e Protezione Civile
+    dati: contesto con i dati già caricati (opzionale)"""
+
+    if dati is not None:
+        return dati["dpc"], dati["tassi_std"]
+
+    # Dati nazionali sui contagi
+    df_IT = import_dpc_data()
 
     # Ricava i tassi standardizzati per fascia di età
     df_tassi_std = compute_incidence_std()
@@ -116,18 +128,16 @@ def plot_confronto_2020_2021(show=False):
         plt.show()
 
 
-if __name__ == "__main__":
-    # Set work directory for the script
-    scriptpath = path.dirname(path.realpath(__file__))
-    chdir(scriptpath)
-
-    # Set locale to "it" to parse the month correctly
-    locale.setlocale(locale.LC_ALL, "it_IT.UTF-8")
+def prepare(dati=None):
+    """ Carica i dati e imposta le variabili usate dai grafici
+    dati: contesto con i dati già caricati (opzionale)"""
+    global df_IT, df_tassi_std, end_date, casi_2020, dec_2020, x_ticks, x_labels, \
+        casi_2021_vacc, casi_2021_novacc, dec_2021_vacc, dec_2021_novacc
 
     # Imposta stile grafici
     apply_plot_treatment()
 
-    df_IT, df_tassi_std = import_data()
+    df_IT, df_tassi_std = import_data(dati)
 
     # Calcola data fine df 2020-21
     # E' il primo giorno del mese successivo alla data dell'ultimo report
@@ -138,5 +148,26 @@ if __name__ == "__main__":
     casi_2020, dec_2020, x_ticks, x_labels = get_epidemic_data_2020()
     casi_2021_vacc, casi_2021_novacc, dec_2021_vacc, dec_2021_novacc = get_epidemic_data_2021()
 
-    # Plot data
-    plot_confronto_2020_2021()
+
+def get_plots():
+    """ Grafici da generare: (funzione, argomenti) """
+    return [(plot_confronto_2020_2021, {})]
+
+
+def main(dati=None):
+    """ Genera i grafici
+    dati: contesto con i dati già caricati (opzionale)"""
+    prepare(dati)
+    for plot, kwargs in get_plots():
+        plot(**kwargs)
+
+
+if __name__ == "__main__":
+    # Set work directory for the script
+    scriptpath = path.dirname(path.realpath(__file__))
+    chdir(scriptpath)
+
+    # Set locale to "it" to parse the month correctly
+    locale.setlocale(locale.LC_ALL, "it_IT.UTF-8")
+
+    main()
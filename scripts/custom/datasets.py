@@ -0,0 +1,120 @@
+""" Download dei dataset remoti (OWID, JHU, Protezione Civile, platea)
+con cache su disco.
+
+Il csv scaricato viene salvato insieme ad ETag/Last-Modified e riusato
+per TTL secondi; scaduto il TTL viene rivalidato con una richiesta
+condizionale. Il dataframe ottenuto dal csv viene salvato in formato
+binario (pickle), così i caricamenti successivi non rileggono il csv.
+Con la variabile d'ambiente DATASETS_OFFLINE=1 si usa solo la cache. """
+import hashlib
+import json
+from io import BytesIO
+from os import environ, getpid, makedirs, path, replace
+from time import time
+from urllib import request
+from urllib.error import HTTPError, URLError
+
+import pandas as pd
+
+CACHE_DIR = path.join("cache", "datasets")
+
+# i dati vengono aggiornati al più una volta al giorno,
+# lo script viene eseguito ogni ora
+DEFAULT_TTL = 3600
+
+
+def is_offline():
+    return environ.get("DATASETS_OFFLINE", "0") == "1"
+
+
+def _cache_key(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()[:24]
+
+
+def _read_meta(meta_file):
+    if not path.exists(meta_file):
+        return None
+    with open(meta_file, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _write_atomic(filename, content, mode="wb"):
+    # file temporaneo per processo: i grafici sono generati in parallelo
+    tmp_file = f"{filename}.{getpid()}.tmp"
+    with open(tmp_file, mode) as f:
+        f.write(content)
+    replace(tmp_file, filename)
+
+
+def fetch_csv(url, ttl=DEFAULT_TTL, cache_dir=CACHE_DIR):
+    """ Scarica (se necessario) il csv, restituisce il percorso del file
+    in cache e i relativi metadati """
+
+    makedirs(cache_dir, exist_ok=True)
+    key = _cache_key(url)
+    csv_file = path.join(cache_dir, f"{key}.csv")
+    meta_file = path.join(cache_dir, f"{key}.json")
+    meta = _read_meta(meta_file) if path.exists(csv_file) else None
+
+    if meta is not None and (is_offline() or time() - meta["fetched_at"] < ttl):
+        return csv_file, meta
+    if meta is None and is_offline():
+        raise FileNotFoundError(f"{url} non disponibile in cache (modalità offline)")
+
+    # richiesta condizionale
+    req = request.Request(url)
+    if meta is not None:
+        if meta.get("etag"):
+            req.add_header("If-None-Match", meta["etag"])
+        if meta.get("last_modified"):
+            req.add_header("If-Modified-Since", meta["last_modified"])
+
+    try:
+        with request.urlopen(req) as response:
+            content = response.read()
+            headers = response.headers
+    except HTTPError as e:
+        if e.code != 304 or meta is None:
+            raise
+        # non modificato
+        meta["fetched_at"] = time()
+        _write_atomic(meta_file, json.dumps(meta), mode="w")
+        return csv_file, meta
+    except URLError as e:
+        if meta is None:
+            raise
+        print(f"{url} non raggiungibile ({e.reason}), uso la copia in cache")
+        return csv_file, meta
+
+    _write_atomic(csv_file, content)
+    meta = {"url": url,
+            "sha256": hashlib.sha256(content).hexdigest(),
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified"),
+            "fetched_at": time()}
+    _write_atomic(meta_file, json.dumps(meta), mode="w")
+    return csv_file, meta
+
+
+def read_remote_csv(url, ttl=DEFAULT_TTL, cache_dir=CACHE_DIR, **read_csv_kwargs):
+    """ Equivalente di pd.read_csv(url, **read_csv_kwargs) con cache:
+    il dataframe viene riletto dal formato binario finché il csv
+    scaricato non cambia """
+
+    csv_file, meta = fetch_csv(url, ttl=ttl, cache_dir=cache_dir)
+
+    # il df dipende sia dal contenuto del csv che dalle opzioni di lettura
+    frame_file = path.join(cache_dir, f"{_cache_key(url, read_csv_kwargs)}.pkl")
+    frame_meta_file = frame_file.replace(".pkl", ".json")
+    frame_meta = _read_meta(frame_meta_file)
+    if path.exists(frame_file) and frame_meta is not None \
+            and frame_meta["sha256"] == meta["sha256"]:
+        return pd.read_pickle(frame_file)
+
+    with open(csv_file, "rb") as f:
+        df = pd.read_csv(BytesIO(f.read()), **read_csv_kwargs)
+    tmp_file = f"{frame_file}.{getpid()}.tmp"
+    df.to_pickle(tmp_file)
+    replace(tmp_file, frame_file)
+    _write_atomic(frame_meta_file, json.dumps({"sha256": meta["sha256"]}), mode="w")
+    return df
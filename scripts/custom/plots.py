@@ -3,6 +3,8 @@ import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 
+from custom.preprocessing_dataframe import read_dati_iss
+
 # see: https://personal.sron.nl/~pault/
 palette = ["#EE7733", "#0077BB", "#33BBEE", "#EE3377", "#CC3311", "#009988", "#BBBBBB"]
 titoli = ["nuovi casi", "ospedalizzazioni", "ingressi TI", "decessi"]
@@ -43,7 +45,7 @@ def apply_plot_treatment():
 
 def get_xticks_labels(reports_dates=None, full=False):
     if reports_dates is None:
-        df_assoluti = pd.read_excel("../dati/dati_ISS_complessivi.xlsx", sheet_name="dati epidemiologici")
+        df_assoluti = read_dati_iss()[0].reset_index()
         df_assoluti = df_assoluti[df_assoluti["data"] > "2021-07-28"]
         reports_dates = pd.to_datetime(df_assoluti["data"])
     if full:
@@ -2,6 +2,8 @@ import numpy as np
 import pandas as pd
 from sklearn.metrics import r2_score
 
+from custom.datasets import read_remote_csv
+
 paesi_abitanti_eu = {"Austria": 8.917, "Belgium": 11.56, "Bulgaria": 6.927,
                      "Cyprus": 1.207, "Croatia": 4.047, "Denmark": 5.831,
                      "Estonia": 1.331, "Finland": 5.531, "France": 67.39,
@@ -51,9 +53,23 @@ def import_vaccines_data():
     """ Recupera dati sui vaccini da Our World in Data"""
 
     url = "https://raw.githubusercontent.com/owid/covid-19-data/master/public/data/vaccinations/vaccinations.csv"
-    df_vacc = pd.read_csv(url)
-    df_vacc = df_vacc.fillna(method="ffill")
-    return df_vacc
+    vacc_cols = ["people_vaccinated_per_hundred", "people_fully_vaccinated_per_hundred"]
+
+    # leggi solo le colonne usate, con tipi compatti
+    df_vacc = read_remote_csv(url,
+                              usecols=["location", "date"] + vacc_cols,
+                              dtype={"location": "category",
+                                     "people_vaccinated_per_hundred": "float32",
+                                     "people_fully_vaccinated_per_hundred": "float32"},
+                              parse_dates=["date"])
+
+    # tieni solo i 27 paesi UE
+    df_vacc = df_vacc[df_vacc["location"].isin(paesi_abitanti_eu.keys())].copy()
+    df_vacc["location"] = df_vacc["location"].cat.remove_unused_categories()
+
+    # riempi i dati mancanti separatamente per ciascun paese
+    df_vacc[vacc_cols] = df_vacc.groupby("location", observed=True)[vacc_cols].ffill()
+    return df_vacc.reset_index(drop=True)
 
 
 def get_vaccine_data(df_vacc, country):
@@ -80,14 +96,32 @@ def import_epidem_data():
     file_confirmed = base + "time_series_covid19_confirmed_global.csv"
     file_deaths = base + "time_series_covid19_deaths_global.csv"
     file_recovered = base + "time_series_covid19_recovered_global.csv"
-    return pd.read_csv(file_confirmed), pd.read_csv(file_deaths), pd.read_csv(file_recovered)
+    return (aggregate_by_country(read_remote_csv(file_confirmed)),
+            aggregate_by_country(read_remote_csv(file_deaths)),
+            aggregate_by_country(read_remote_csv(file_recovered)))
+
+
+def aggregate_by_country(df):
+    """ Somma le province di ciascun paese, una sola volta:
+    restituisce un df indicizzato per paese con una colonna per data """
+    df_country = df.drop(columns=["Province/State", "Lat", "Long"])
+    df_country = df_country.groupby("Country/Region").sum()
+    df_country.columns = pd.to_datetime(df_country.columns)
+    return df_country
+
+
+def get_country_data(df, country):
+    """ Serie temporale del paese (zero se il paese non è presente) """
+    if country not in df.index:
+        return pd.Series(0, index=df.columns)
+    return df.loc[country]
 
 
 def get_epidemic_data(country, df_confirmed, df_deaths, df_recovered):
     """ Recupera dati epidemiologia per paese """
-    ydata_cases = (df_confirmed[df_confirmed["Country/Region"] == country].iloc[:, 4:]).sum()
-    ydata_deaths = (df_deaths[df_deaths["Country/Region"] == country].iloc[:, 4:]).sum()
-    ydata_rec = (df_recovered[df_recovered["Country/Region"] == country].iloc[:, 4:]).sum()
+    ydata_cases = get_country_data(df_confirmed, country)
+    ydata_deaths = get_country_data(df_deaths, country)
+    ydata_rec = get_country_data(df_recovered, country)
     ydata_inf = ydata_cases-ydata_deaths-ydata_rec
     daily_cases = ydata_cases.diff().rolling(window=7).mean()
     daily_deaths = ydata_deaths.diff().rolling(window=7).mean()
@@ -97,7 +131,7 @@ def get_epidemic_data(country, df_confirmed, df_deaths, df_recovered):
                                              ydata_rec,
                                              daily_cases,
                                              daily_deaths]))
-    df_epidemic.index = pd.to_datetime(df_confirmed.columns[4:])
+    df_epidemic.index = df_confirmed.columns
     df_epidemic.columns = ["Total cases",
                            "Active infected",
                            "Total deaths",
@@ -107,32 +141,20 @@ def get_epidemic_data(country, df_confirmed, df_deaths, df_recovered):
     return df_epidemic
 
 
-def get_frac_vacc(df_vacc, country, days_ago=30, fully=False):
-    """ Recupera dati sulla frazione di vaccinati """
-    frac_vacc = get_vaccine_data(df_vacc, country)["% fully vaccinated"
-                                                   if fully else
-                                                   "% vaccinated with 1 dose"]
-    return frac_vacc.iloc[-days_ago]
-
-
-def get_deaths(df_deaths, country, time_window=30, t0=-1):
-    """ Recupera decessi per la finestra temporale selezionata """
-    decessi = np.array(df_deaths[df_deaths["Country/Region"] == country].iloc[:, 4:].sum())
-    decessi_ultimi_Ngiorni = decessi[t0] - decessi[t0-(time_window+1)]
-    return decessi_ultimi_Ngiorni
-
-
 def compute_vaccini_decessi_eu(df_vacc, df_deaths, time, fully=True):
     """ calcola vaccini e decessi nei 27 Paesi europei """
 
-    dec_res_2021 = []
-    vacc_res_2021 = []
+    paesi = list(paesi_abitanti_eu.keys())
+    abitanti = np.array(list(paesi_abitanti_eu.values()))
     t0 = -1
-    for p, abitanti in paesi_abitanti_eu.items():
-        vacc_res_2021.append(get_frac_vacc(df_vacc,
-                                           p,
-                                           days_ago=time,
-                                           fully=fully))
-        dec_res_2021.append(get_deaths(df_deaths, p, time_window=time, t0=t0)/abitanti)
-    dec_res_2021 = np.array(dec_res_2021)
+
+    # frazione di vaccinati "time" giorni fa, per tutti i paesi
+    vacc_col = "people_fully_vaccinated_per_hundred" if fully else "people_vaccinated_per_hundred"
+    days_from_end = df_vacc.groupby("location", observed=True).cumcount(ascending=False)
+    df_frac_vacc = df_vacc[days_from_end == time - 1].set_index("location")[vacc_col]
+    vacc_res_2021 = df_frac_vacc.reindex(paesi).to_numpy(dtype=float)
+
+    # decessi nella finestra temporale, per tutti i paesi
+    decessi = df_deaths.reindex(paesi, fill_value=0).to_numpy()
+    dec_res_2021 = (decessi[:, t0] - decessi[:, t0-(time+1)])/abitanti
     return vacc_res_2021, dec_res_2021
@@ -1,12 +1,45 @@
+import sys
+import warnings
+from functools import lru_cache
+from math import erf, sqrt
+from os import path
+
 import numpy as np
 import pandas as pd
 
+from custom.datasets import read_remote_csv
+
+# lettura dello store dei dati ISS, condivisa con dati/dati_selezione.py
+sys.path.append(path.join(path.dirname(path.abspath(__file__)), "..", "..", "dati"))
+from iss_store import read_store  # noqa: E402
+
+# eventi, popolazioni usate come denominatore
+# e stati vaccinali confrontati con i non vaccinati
+EVENTI = ["casi", "ospedalizzati", "terapia intensiva", "decessi"]
+DENOMINATORI = {"casi": "casi", "ospedalizzati": "ospedalizzati/ti",
+                "terapia intensiva": "ospedalizzati/ti", "decessi": "decessi"}
+STATI_VACCINALI = ["vaccinati 1 dose", "vaccinati > 4-6 mesi", "vaccinati < 4-6 mesi",
+                   "booster", "qt dose", "vaccinati completo"]
+
+
+@lru_cache(maxsize=None)
+def _read_dati_iss(filename):
+    """ Store parquet e log (o xlsx, se lo store non è ancora stato creato) """
+    return read_store(f"../dati/{filename}")
+
+
+def read_dati_iss(filename="dati_ISS_complessivi"):
+    """ Legge i dati ISS dallo store parquet,
+    restituisce dati epidemiologici e popolazioni indicizzati per data """
+    df_epid, df_pop = _read_dati_iss(filename)
+    return df_epid.copy(), df_pop.copy()
+
 
 def get_df_complessivo():
     # dati ISS
-    df_complessivo = pd.read_excel("../dati/dati_ISS_complessivi.xlsx", sheet_name=None)
-    df_epid = df_complessivo["dati epidemiologici"]
-    df_pop = df_complessivo["popolazioni"]
+    df_epid, df_pop = read_dati_iss()
+    df_epid = df_epid.reset_index()
+    df_pop = df_pop.reset_index()
     df_epid = df_epid[df_epid["data"] > "2021-07-28"]
     df_pop = df_pop[df_pop["data"] > "2021-07-28"]
     return df_epid, df_pop
@@ -20,8 +53,8 @@ def compute_incidence(df_epid, df_pop, eventi_templ=["%s non vaccinati", "%s vac
     # ricava i tassi dividendo per la popolazione vaccinata e non vaccinata
 
     # eventi interessati
-    num_labs = ["casi", "ospedalizzati", "terapia intensiva", "decessi"]
-    den_labs = ["casi", "ospedalizzati/ti", "ospedalizzati/ti", "decessi"]
+    num_labs = EVENTI
+    den_labs = [DENOMINATORI[evento] for evento in EVENTI]
 
     # template labels colonne
     templates = ["%s non vaccinati", "%s vaccinati 1 dose", "%s vaccinati > 4-6 mesi",
@@ -44,11 +77,78 @@ def compute_incidence(df_epid, df_pop, eventi_templ=["%s non vaccinati", "%s vac
     return df_tassi, selezione
 
 
-def get_df_popolazione():
+def _allinea_età(df_epid, df_pop):
+    """ Indicizza per (data, età) e allinea le popolazioni agli eventi """
+    df_epid = df_epid.set_index("età", append=True)
+    df_pop = df_pop.set_index("età", append=True).reindex(df_epid.index)
+    return df_epid, df_pop
+
+
+def compute_incidence_cube(df_epid, df_pop):
+    """ Calcola in un unico passaggio, per ogni data e fascia d'età:
+    - "giornalieri": numeri assoluti giornalieri (media 30 giorni)
+    - "incidenza": incidenze per 100.000
+    - "rapporto": contributo dei non vaccinati alle incidenze (%)
+    df_epid, df_pop: dati per età indicizzati per data, con colonna "età"
+    return: df con indice (data, età) e colonne (grandezza, evento) """
+
+    df_epid, df_pop = _allinea_età(df_epid, df_pop)
+
+    df_tassi, _ = compute_incidence(df_epid, df_pop)
+    df_tassi.index = df_epid.index
+
+    eventi = ["casi", "ospedalizzati", "terapia intensiva", "decessi"]
+    non_vacc = df_tassi[[f"{evento} non vaccinati" for evento in eventi]].to_numpy()
+    vacc = df_tassi[[f"{evento} vaccinati completo" for evento in eventi]].to_numpy()
+    # incidenze nulle o mancanti: rapporto NaN, senza warning
+    with np.errstate(invalid="ignore", divide="ignore"):
+        rapporti = non_vacc/(non_vacc + vacc)*100
+    df_rapporti = pd.DataFrame(rapporti,
+                               index=df_epid.index,
+                               columns=["Casi", "Ospedalizzati", "TI", "Deceduti"])
+
+    return pd.concat({"giornalieri": df_epid/30,
+                      "incidenza": df_tassi,
+                      "rapporto": df_rapporti}, axis=1)
+
+
+def compute_efficacia_cube(df_tassi):
+    """ Calcola l'efficacia (1 - RR)*100 per ogni riga (es. data, età),
+    evento e stato vaccinale, rispetto ai non vaccinati.
+    Se l'incidenza dei non vaccinati è nulla RR vale 0 (efficacia 100%)
+    df_tassi: incidenze, es. compute_incidence_cube(...)["incidenza"]
+    return: df con lo stesso indice e colonne (evento, stato) """
+
+    non_vacc = df_tassi[[f"{evento} non vaccinati" for evento in EVENTI]].to_numpy()
+    vacc = df_tassi[compose_labels(EVENTI, [f"%s {stato}" for stato in STATI_VACCINALI])]
+    vacc = vacc.to_numpy().reshape(len(df_tassi), len(EVENTI), len(STATI_VACCINALI))
+
+    # rischio relativo, con denominatore nullo esplicito
+    den_nullo = np.broadcast_to((non_vacc == 0)[:, :, None], vacc.shape)
+    rr = np.divide(vacc, non_vacc[:, :, None],
+                   out=np.zeros_like(vacc, dtype=float),
+                   where=~den_nullo)
+
+    colonne = pd.MultiIndex.from_product([EVENTI, STATI_VACCINALI],
+                                         names=["evento", "stato"])
+    return pd.DataFrame(((1 - rr)*100).reshape(len(df_tassi), -1),
+                        index=df_tassi.index, columns=colonne)
+
+
+# popolazioni standard per la standardizzazione per età:
+# - "platea": platea vaccinale italiana (covid19-opendata-vaccini)
+# - "ESP2013": European Standard Population 2013 (Eurostat), la classe
+#   10-14 anni è divisa tra 5-11 e 12-39 in parti uguali per anno di età
+POPOLAZIONI_STANDARD = ("platea", "ESP2013")
+ESP2013 = {"5-11": 7700, "12-39": 34300, "40-59": 27500, "60-79": 20500, "80+": 5000}
+
+
+@lru_cache(maxsize=None)
+def _get_df_popolazione():
     # dati ISS platea vaccinazioni
     # https://github.com/italia/covid19-opendata-vaccini
     url = "https://raw.githubusercontent.com/italia/covid19-opendata-vaccini/master/dati/platea.csv"
-    df_plat = pd.read_csv(url)
+    df_plat = read_remote_csv(url)
     df_plat = df_plat.groupby("eta").sum()
     map_dict = {
       "5-11": "05-11",
@@ -63,46 +163,171 @@ def get_df_popolazione():
     return pd.DataFrame(pop_dict).T
 
 
-def compute_incidence_std():
-    def calc_df_adj(df_tassi):
-        # recupera popolazione (pesi)
-        df_pesi = get_df_popolazione()
-        # filtra classe età 5-11
-        df_pesi = df_pesi[df_pesi.index != "5-11"]
-        # aggiungi colonna pesi a df tassi
-        df_tassi_ = df_tassi.reset_index().merge(df_pesi,
-                                                 how="left",
-                                                 left_on="età",
-                                                 right_on=df_pesi.index,
-                                                 sort=False).set_index("data")
-        weights = df_tassi_["totale_popolazione"].to_numpy()
-        weights_sum = df_pesi["totale_popolazione"].sum()
-        # moltiplica i tassi calcolati per i pesi
-        df_tassi_adj = df_tassi_.iloc[:, 1:-1].mul(weights, axis=0).reset_index()
-        # somma tassi
-        df_tassi_adj = df_tassi_adj.groupby("data").agg(sum)
-        # dividi per somma pesi
-        df_tassi_adj = df_tassi_adj.apply(lambda x: x/weights_sum)
-        df_tassi_adj = df_tassi_adj.replace(0, np.nan)
-        return df_tassi_adj
-
-    df_età = pd.read_excel("../dati/dati_ISS_età.xlsx", sheet_name=None, index_col="età")
-    df_età_epid = df_età["dati epidemiologici"]
-    df_età_epid = df_età_epid[df_età_epid.index != "5-11"]
-    df_età_pop = df_età["popolazioni"]
-    df_età_pop = df_età_pop[df_età_pop.index != "5-11"]
-    df_età_epid = df_età_epid[df_età_epid["data"] > "2021-07-28"]
-    df_età_pop = df_età_pop[df_età_pop["data"] > "2021-07-28"]
+def get_df_popolazione():
+    """ Platea vaccinale per fascia d'età (scaricata una sola volta) """
+    return _get_df_popolazione().copy()
+
 
-    df_tassi, _ = compute_incidence(df_età_epid, df_età_pop)
+@lru_cache(maxsize=None)
+def _pesi_standard(popolazione):
+    """ Pesi per fascia d'età (esclusa 5-11) della popolazione standard """
+    if popolazione == "platea":
+        pesi = _get_df_popolazione()["totale_popolazione"]
+    elif popolazione == "ESP2013":
+        pesi = pd.Series(ESP2013)
+    else:
+        raise ValueError(f"popolazione standard {popolazione!r} non supportata, "
+                         f"scegliere tra {POPOLAZIONI_STANDARD}")
+    return pesi[pesi.index != "5-11"].astype(float)
+
+
+@lru_cache(maxsize=None)
+def _cubo_tassi_età():
+    """ Tassi per 100.000 per data, fascia d'età ed evento
+    (dal 29/07/2021, esclusa la fascia 5-11)
+    return: date, fasce d'età, eventi, array (data × età × evento) """
 
+    df_età_epid, df_età_pop = read_dati_iss("dati_ISS_età")
+    df_età_epid = df_età_epid.set_index("età", append=True)
+    df_età_pop = df_età_pop.set_index("età", append=True)
+
+    date_età = df_età_epid.index.get_level_values("data")
+    classi_età = df_età_epid.index.get_level_values("età")
+    df_età_epid = df_età_epid[(classi_età != "5-11") & (date_età > "2021-07-28")]
+    df_età_pop = df_età_pop.reindex(df_età_epid.index)
+
+    df_tassi, _ = compute_incidence(df_età_epid, df_età_pop)
     df_tassi.index = df_età_epid.index
-    df_tassi = df_tassi.reset_index()
-    df_tassi.index = df_età_epid["data"]
 
-    return calc_df_adj(df_tassi)
+    # (data, età) mancanti: NaN, come le righe assenti
+    date = df_tassi.index.get_level_values("data").unique().sort_values()
+    età = df_tassi.index.get_level_values("età").unique()
+    indice = pd.MultiIndex.from_product([date, età], names=["data", "età"])
+    cubo = df_tassi.reindex(indice).to_numpy().reshape(len(date), len(età), -1)
+    cubo.setflags(write=False)
+    return date, età, list(df_tassi.columns), cubo
+
+
+def compute_incidence_std(popolazione="platea"):
+    """ Tassi standardizzati per età (per 100.000)
+    popolazione: popolazione standard (vedi POPOLAZIONI_STANDARD)
+    I tassi per età vengono calcolati una sola volta,
+    cambiando popolazione cambiano solo i pesi """
+
+    date, età, eventi, cubo = _cubo_tassi_età()
+    pesi = _pesi_standard(popolazione)
+
+    # media pesata sulle fasce d'età (peso 0 per le fasce senza peso)
+    pesi_età = pesi.reindex(età).fillna(0).to_numpy()
+    tassi_std = np.einsum("dae,a->de", np.nan_to_num(cubo), pesi_età)/pesi.sum()
+
+    df_tassi_std = pd.DataFrame(tassi_std,
+                                index=pd.DatetimeIndex(date, name="data"),
+                                columns=eventi)
+    return df_tassi_std.replace(0, np.nan)
+
+
+def quantile_normale(p):
+    """ Quantile p della normale standard, per bisezione su erf
+    (statistics.NormalDist richiede Python 3.8) """
+
+    inf, sup = -10.0, 10.0
+    for _ in range(100):
+        z = (inf + sup)/2
+        if (1 + erf(z/sqrt(2)))/2 < p:
+            inf = z
+        else:
+            sup = z
+    return (inf + sup)/2
+
+
+def poisson_ci(conteggi, livello=0.95):
+    """ Intervalli di confidenza di conteggi Poisson, elemento per elemento
+    (approssimazione di Byar, limite inferiore 0 per conteggi nulli)
+    conteggi: array di conteggi
+    livello: livello di confidenza
+    return: limiti inferiori e superiori """
+
+    z = quantile_normale((1 + livello)/2)
+    k = np.asarray(conteggi, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        inf = k*(1 - 1/(9*k) - z/(3*np.sqrt(k)))**3
+    inf = np.where(k == 0, 0, inf)
+    k1 = k + 1
+    sup = k1*(1 - 1/(9*k1) + z/(3*np.sqrt(k1)))**3
+    return inf, sup
+
+
+def compute_incidence_ci(df_epid, df_pop, livello=0.95):
+    """ Intervalli di confidenza (Poisson) delle incidenze per 100.000
+    di tutte le righe ed eventi di compute_incidence
+    df_epid, df_pop: eventi e popolazioni, con le stesse righe
+    livello: livello di confidenza
+    return: df con limiti inferiori e superiori """
+
+    templates = ["%s non vaccinati"] + [f"%s {stato}" for stato in STATI_VACCINALI]
+    num_labs = compose_labels(EVENTI, templates)
+    den_labs = compose_labels([DENOMINATORI[evento] for evento in EVENTI], templates)
+
+    inf, sup = poisson_ci(df_epid[num_labs].to_numpy(), livello)
+    pop = df_pop[den_labs].to_numpy(dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        limiti = [pd.DataFrame(10**5*lim/pop, index=df_epid.index, columns=num_labs)
+                  .replace([np.inf, -np.inf], np.nan)
+                  for lim in (inf, sup)]
+    return tuple(limiti)
+
+
+def compute_efficacia_ci(df_epid, df_pop, livello=0.95, n_bootstrap=0, seed=0, batch=100):
+    """ Intervalli di confidenza dell'efficacia (1 - RR)*100
+    di compute_efficacia_cube, per ogni data, età, evento e stato vaccinale:
+    - log-RR: exp(log RR ± z*sqrt(1/a + 1/b)), con a e b eventi
+      dei vaccinati e dei non vaccinati (NaN se a o b sono nulli)
+    - con n_bootstrap > 0: bootstrap parametrico, a e b estratti
+      da distribuzioni di Poisson con seme fissato, a blocchi di batch
+    df_epid, df_pop: dati per età indicizzati per data, con colonna "età"
+    livello: livello di confidenza
+    return: df con limiti inferiori e superiori, colonne (evento, stato) """
+
+    df_epid, df_pop = _allinea_età(df_epid, df_pop)
+    forma = (len(df_epid), len(EVENTI), len(STATI_VACCINALI))
+
+    # eventi e popolazioni dei vaccinati (a, n1) e dei non vaccinati (b, n0)
+    templates = [f"%s {stato}" for stato in STATI_VACCINALI]
+    a = df_epid[compose_labels(EVENTI, templates)].to_numpy(dtype=float).reshape(forma)
+    n1 = df_pop[compose_labels([DENOMINATORI[evento] for evento in EVENTI], templates)]
+    n1 = n1.to_numpy(dtype=float).reshape(forma)
+    b = df_epid[[f"{evento} non vaccinati" for evento in EVENTI]].to_numpy(dtype=float)[:, :, None]
+    n0 = df_pop[[f"{DENOMINATORI[evento]} non vaccinati" for evento in EVENTI]]
+    n0 = n0.to_numpy(dtype=float)[:, :, None]
 
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if n_bootstrap > 0:
+            rng = np.random.default_rng(seed)
+            rr = np.empty((n_bootstrap,) + forma, dtype=np.float32)
+            for inizio in range(0, n_bootstrap, batch):
+                n_batch = min(batch, n_bootstrap - inizio)
+                a_b = rng.poisson(np.nan_to_num(a), (n_batch,) + forma)
+                b_b = rng.poisson(np.nan_to_num(b), (n_batch,) + b.shape)
+                rr[inizio:inizio + n_batch] = np.where(b_b > 0, (a_b/n1)/(b_b/n0), np.nan)
+            with warnings.catch_warnings():
+                # celle senza dati: limiti NaN
+                warnings.simplefilter("ignore", RuntimeWarning)
+                rr_inf, rr_sup = np.nanquantile(rr, [(1 - livello)/2, (1 + livello)/2], axis=0)
+            mancanti = np.isnan(a) | np.isnan(b)
+            rr_inf[mancanti] = np.nan
+            rr_sup[mancanti] = np.nan
+        else:
+            z = quantile_normale((1 + livello)/2)
+            log_rr = np.log((a/n1)/(b/n0))
+            se = np.sqrt(1/a + 1/b)
+            validi = (a > 0) & (b > 0) & (n1 > 0) & (n0 > 0)
+            rr_inf = np.where(validi, np.exp(log_rr - z*se), np.nan)
+            rr_sup = np.where(validi, np.exp(log_rr + z*se), np.nan)
 
-def safe_div(df, col1, col2):
-    """ Function to handle ZeroDivisionError """
-    return df.apply(lambda x: x[col2] and x[col1]/x[col2] or 0, axis=1)
+    colonne = pd.MultiIndex.from_product([EVENTI, STATI_VACCINALI],
+                                         names=["evento", "stato"])
+    # l'efficacia decresce con RR: i limiti si scambiano
+    return tuple(pd.DataFrame(((1 - rr_lim)*100).reshape(len(df_epid), -1),
+                              index=df_epid.index, columns=colonne)
+                 for rr_lim in (rr_sup, rr_inf))
@@ -1,5 +1,7 @@
+import json
 from datetime import datetime
-from itertools import takewhile
+from functools import lru_cache
+from os import getpid, makedirs, path, replace
 
 import numpy as np
 from matplotlib.font_manager import FontProperties, findfont
@@ -9,6 +11,53 @@ from custom.plots import palette
 
 url = "github.com/apalladi/covid_vaccini_monitoraggio"
 
+# font size già calcolati, condivisi tra le esecuzioni
+FONTSIZE_CACHE_FILE = path.join("cache", "fontsizes.json")
+
+
+def _load_fontsizes(cache_file):
+    if cache_file is None or not path.exists(cache_file):
+        return {}
+    with open(cache_file, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _save_fontsizes(fontsizes, cache_file):
+    makedirs(path.dirname(cache_file) or ".", exist_ok=True)
+    tmp_file = f"{cache_file}.{getpid()}.tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(fontsizes, f, indent=2)
+    replace(tmp_file, cache_file)
+
+
+@lru_cache(maxsize=None)
+def fit_fontsize(font_path, text, max_width, cache_file=FONTSIZE_CACHE_FILE):
+    """ Calcola la dimensione massima del font (in pixel)
+    per cui il testo è più stretto di max_width pixel.
+    La larghezza del testo cresce con la dimensione del font:
+    la ricerca è per bisezione, il risultato viene memorizzato
+    (anche su disco se cache_file non è None) """
+
+    key = f"{font_path}|{text}|{max_width}"
+    fontsizes = _load_fontsizes(cache_file)
+    if key in fontsizes:
+        return fontsizes[key]
+
+    # lo: dimensione accettata, hi: dimensione troppo grande
+    lo, hi = 0, max_width
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if ImageFont.truetype(font_path, mid).getsize(text)[0] < max_width:
+            lo = mid
+        else:
+            hi = mid
+
+    if cache_file is not None:
+        fontsizes = _load_fontsizes(cache_file)
+        fontsizes[key] = lo
+        _save_fontsizes(fontsizes, cache_file)
+    return lo
+
 
 def watermark_specs(figure, watermark):
     # Get the default Matplotlib font
@@ -24,11 +73,9 @@ def watermark_specs(figure, watermark):
     # Get Watermark width (Pixels)
     watermark_wd = int(figure_fraction * figure_wd)
 
-    # Calculate the scaled fontsize - iterate until the text size is
-    # larger than the text width and take the max value
-    fontsize = max(takewhile(lambda i: ImageFont.truetype(default_font, i)
-                   .getsize(watermark)[0] < watermark_wd,
-                   range(1, watermark_wd))) - 1
+    # Calculate the scaled fontsize - the max value for which
+    # the text size is smaller than the text width
+    fontsize = fit_fontsize(default_font, watermark, watermark_wd) - 1
     # Calculate appropriate rotation and convert to degree (r * 180°/pi)
     angle = np.arctan(figure_ht/figure_wd)*(180/np.pi)
 
@@ -6,23 +6,32 @@ from os import chdir, path
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
 
 from custom.plots import (add_suptitle, add_title, apply_plot_treatment,
                           palette, set_size)
-from custom.preprocessing_dataframe import compute_incidence, safe_div
+from custom.preprocessing_dataframe import (EVENTI, compute_efficacia_ci,
+                                            compute_efficacia_cube,
+                                            compute_incidence,
+                                            compute_incidence_cube,
+                                            read_dati_iss)
 from custom.watermarks import add_last_updated, add_watermark
 
 colori_incidenza = [palette[i] for i in [6, 0, 1, 2, 3]]
 
 
 def compute_efficacia():
-    """ Calcola efficacia vaccini """
-    eff_contagio = (1 - safe_div(df_tassi, "casi vaccinati completo", "casi non vaccinati"))*100
-    eff_osp = (1 - safe_div(df_tassi, "ospedalizzati vaccinati completo", "ospedalizzati non vaccinati"))*100
-    eff_terint = (1 - safe_div(df_tassi, "terapia intensiva vaccinati completo", "terapia intensiva non vaccinati"))*100
-    eff_decessi = (1 - safe_div(df_tassi, "decessi vaccinati completo", "decessi non vaccinati"))*100
-    return eff_contagio, eff_osp, eff_terint, eff_decessi
+    """ Efficacia vaccini (vaccinati completo) del report più recente,
+    per fascia d'età: contagio, ospedalizzazione, TI, decesso """
+    df_eff = df_efficacia.xs(csv_date, level="data")
+    return tuple(df_eff[evento, "vaccinati completo"] for evento in EVENTI)
+
+
+def get_err_efficacia(eff, evento):
+    """ Barre d'errore dell'efficacia (IC 95%, log-RR)
+    del report più recente per fascia d'età """
+    inf = df_efficacia_inf.xs(csv_date, level="data")[evento, "vaccinati completo"]
+    sup = df_efficacia_sup.xs(csv_date, level="data")[evento, "vaccinati completo"]
+    return np.array([eff - inf, sup - eff])
 
 
 # Funzioni per il plot
@@ -99,19 +108,23 @@ def plot_efficacia(show=False):
                                                               subplots=(2, 2)))
     axes = ax.ravel()
 
-    axes[0].bar(eff_contagio.index, eff_contagio, color=palette[1], width=0.5)
+    axes[0].bar(eff_contagio.index, eff_contagio, color=palette[1], width=0.5,
+                yerr=get_err_efficacia(eff_contagio, "casi"), capsize=3)
     add_title(axes[0], title="Efficacia contro il contagio")
     add_to_plot(axes[0])
 
-    axes[1].bar(eff_osp.index, eff_osp, color=palette[5], width=0.5)
+    axes[1].bar(eff_osp.index, eff_osp, color=palette[5], width=0.5,
+                yerr=get_err_efficacia(eff_osp, "ospedalizzati"), capsize=3)
     add_title(axes[1], title="Efficacia contro l'ospedalizzazione")
     add_to_plot(axes[1])
 
-    axes[2].bar(eff_terint.index, eff_terint, color=palette[4], width=0.5)
+    axes[2].bar(eff_terint.index, eff_terint, color=palette[4], width=0.5,
+                yerr=get_err_efficacia(eff_terint, "terapia intensiva"), capsize=3)
     add_title(axes[2], title="Efficacia contro l'ingresso in TI")
     add_to_plot(axes[2])
 
-    axes[3].bar(eff_decessi.index, eff_decessi, color="black", width=0.5)
+    axes[3].bar(eff_decessi.index, eff_decessi, color="black", width=0.5,
+                yerr=get_err_efficacia(eff_decessi, "decessi"), ecolor=palette[-1], capsize=3)
     add_title(axes[3], title="Efficacia contro il decesso")
     add_to_plot(axes[3])
 
@@ -265,13 +278,12 @@ def plot_focus_60(show=False):
         plt.show()
 
 
-if __name__ == "__main__":
-    # Set work directory for the script
-    scriptpath = path.dirname(path.realpath(__file__))
-    chdir(scriptpath)
-
-    # Set locale to "it" to parse the month correctly
-    locale.setlocale(locale.LC_ALL, "it_IT.UTF-8")
+def prepare(dati=None):
+    """ Carica i dati e imposta le variabili usate dai grafici
+    dati: contesto con i dati già caricati (opzionale)"""
+    global titoli, csv_date, df_età, df_pop, plots_suptitle, df_tassi, eventi, \
+        df_efficacia, df_efficacia_inf, df_efficacia_sup, \
+        eff_contagio, eff_osp, eff_terint, eff_decessi
 
     # Imposta stile grafici
     apply_plot_treatment()
@@ -279,10 +291,7 @@ if __name__ == "__main__":
     titoli = ["nuovi casi", "ospedalizzazioni", "ingressi in TI", "decessi"]
 
     # Recupera dati età
-    df_età = pd.read_excel("../dati/dati_ISS_età.xlsx", sheet_name=None,
-                           index_col="data", parse_dates=["data"])
-    df_età_epid = df_età["dati epidemiologici"]
-    df_età_pop = df_età["popolazioni"]
+    df_età_epid, df_età_pop = read_dati_iss("dati_ISS_età")
     date_reports = df_età_epid.index.unique()
 
     df_età_epid = df_età_epid[df_età_epid["età"] != "5-11"]
@@ -309,10 +318,34 @@ if __name__ == "__main__":
 
     df_tassi.index = df_età["età"]
 
-    # Ricava efficacia
+    # Ricava efficacia per tutti i report, fasce d'età, eventi e stati vaccinali
+    df_efficacia = compute_efficacia_cube(compute_incidence_cube(df_età_epid, df_età_pop)["incidenza"])
+    df_efficacia_inf, df_efficacia_sup = compute_efficacia_ci(df_età_epid, df_età_pop)
     eff_contagio, eff_osp, eff_terint, eff_decessi = compute_efficacia()
 
-    plot_tassi()
-    plot_efficacia()
-    plot_riassunto()
-    plot_focus_60()
+
+def get_plots():
+    """ Grafici da generare: (funzione, argomenti) """
+    return [(plot_tassi, {}),
+            (plot_efficacia, {}),
+            (plot_riassunto, {}),
+            (plot_focus_60, {})]
+
+
+def main(dati=None):
+    """ Genera i grafici
+    dati: contesto con i dati già caricati (opzionale)"""
+    prepare(dati)
+    for plot, kwargs in get_plots():
+        plot(**kwargs)
+
+
+if __name__ == "__main__":
+    # Set work directory for the script
+    scriptpath = path.dirname(path.realpath(__file__))
+    chdir(scriptpath)
+
+    # Set locale to "it" to parse the month correctly
+    locale.setlocale(locale.LC_ALL, "it_IT.UTF-8")
+
+    main()
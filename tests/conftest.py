@@ -0,0 +1,6 @@
+import sys
+from os import path
+
+# The extraction script runs from dati/, the analysis scripts from scripts/
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path[:0] = [path.join(ROOT, "dati"), path.join(ROOT, "scripts")]
@@ -0,0 +1,80 @@
+import multiprocessing as mp
+
+import fitz
+import numpy as np
+import pandas as pd
+import pytest
+
+import dati_selezione
+from test_extract_tables import AGE_GROUPS, make_blocks
+
+# An English month: the test doesn't need the Italian locale
+URL = ("https://www.epicentro.iss.it/coronavirus/bollettino/"
+       "Bollettino-sorveglianza-integrata-COVID-19_05-July-2022.pdf")
+
+
+def make_report(pdf_path, tables):
+    """Writes a report with a page for each table letter"""
+
+    doc = fitz.open()
+    for letter, blocks in tables.items():
+        page = doc.new_page()
+        page.insert_text((50, 60), f"TABELLA 5{letter} - POPOLAZIONE ITALIANA", fontsize=10)
+        y = 100
+        for rows in blocks:
+            for label, row in zip(AGE_GROUPS, rows):
+                page.insert_text((60, y), label, fontsize=8)
+                for x, value in zip(range(200, 560, 60), row):
+                    text = f"{value:,}".replace(",", ".")
+                    width = fitz.get_text_length(text, fontsize=8)
+                    page.insert_text((x + 40 - width, y), text, fontsize=8)
+                y += 14
+            y += 10
+    doc.save(str(pdf_path))
+    doc.close()
+
+
+def empty_store(filename, n_epid, n_pop, by_age=False):
+    index = pd.DatetimeIndex([], name="data")
+    df_0 = pd.DataFrame(np.zeros((0, n_epid), dtype=np.int64), index=index,
+                        columns=[f"e{i}" for i in range(n_epid)])
+    df_1 = pd.DataFrame(np.zeros((0, n_pop), dtype=np.int64), index=index,
+                        columns=[f"p{i}" for i in range(n_pop)])
+    if by_age:
+        df_0.insert(0, "età", pd.Series([], dtype=object))
+        df_1.insert(0, "età", pd.Series([], dtype=object))
+    dati_selezione.write_store(df_0, df_1, filename)
+
+
+@pytest.fixture
+def spawn():
+    start_method = mp.get_start_method()
+    mp.set_start_method("spawn", force=True)
+    yield
+    mp.set_start_method(start_method, force=True)
+
+
+def test_backfill_with_spawned_workers(tmp_path, monkeypatch, spawn):
+    monkeypatch.chdir(tmp_path)
+    tables = {"A": make_blocks(2, seed=1), "B": make_blocks(3, seed=2), "C": make_blocks(2, seed=3)}
+    make_report(tmp_path / "report.pdf", tables)
+    monkeypatch.setattr(dati_selezione, "fetched_reports", {URL: str(tmp_path / "report.pdf")})
+    monkeypatch.setattr(dati_selezione, "get_surveillance_reports", lambda: [URL])
+
+    # 7 columns (6 + "vaccinati completo") for each total
+    empty_store("dati_ISS_complessivi", 28, 21)
+    empty_store("dati_ISS_età", 28, 21, by_age=True)
+
+    dati_selezione.backfill_reports(max_workers=1, export_xlsx=False)
+
+    df_0, df_1 = dati_selezione.read_store("dati_ISS_complessivi")
+    assert list(df_0.index) == [pd.Timestamp("2022-07-05")]
+    totals_b = [tables["B"][1][5], tables["B"][2][5]]
+    expected_epid = [row + [sum(row[3:])]
+                     for row in [tables["A"][1][5], *totals_b, tables["C"][1][5]]]
+    # Table B: hospitalized, then ICU totals
+    assert df_0.iloc[0].tolist() == sum(expected_epid, [])
+    assert df_1.iloc[0].tolist()[:6] == tables["A"][0][5]
+
+    df_età_0, _ = dati_selezione.read_store("dati_ISS_età")
+    assert df_età_0["età"].tolist() == AGE_GROUPS[:5]
@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import dati_selezione
+
+
+def clean_raw_table_regex(sel_df):
+    """The previous implementation, cell by cell with regex and strip"""
+
+    df_raw = sel_df.iloc[:, -6:]
+    df_raw = df_raw[df_raw[df_raw.columns[0]].str.match(r"[0-9]")]
+    df_final = df_raw.replace(r"\((.*)|[^0-9]", "", regex=True)
+    df_final = df_final.apply(lambda x: x.str.strip())
+    df_final = df_final.replace(r"^\s*$", 0, regex=True).apply(np.int64)
+    vaccinati_completo = df_final.iloc[:, 3:].sum(axis=1)
+    df_final.insert(len(df_final.columns), "vaccinati completo", vaccinati_completo)
+    df_final.reset_index(inplace=True, drop=True)
+    return df_final
+
+
+RAW = pd.DataFrame([
+    ["Casi", "", "Non vaccinati", "", "", "", ""],
+    ["5-11", "1.234 (12,3%)", "-", "", "12.345¹", "7", " 8 "],
+    ["12-39", "2.000", "1 568 621", "n.d.", "3.456*", "–", "0"],
+    ["Totale", "3.234", "5", "6", "15.801", "7 (0,1%)", "8"],
+], columns=range(7))
+
+
+def test_same_values_as_the_regex_path():
+    clean_df = dati_selezione.clean_raw_table(RAW)
+    pd.testing.assert_frame_equal(clean_df, clean_raw_table_regex(RAW))
+    assert clean_df.iloc[0].tolist() == [1234, 0, 0, 12345, 7, 8, 12360]
+
+
+def test_parse_failures():
+    clean_df = dati_selezione.clean_raw_table(RAW)
+    # Percentages, dashes and blanks are expected, footnotes and "n.d." are not
+    assert clean_df.attrs["parse_failures"] == [(1, 4, "12.345¹"), (2, 3, "n.d."),
+                                                (2, 4, "3.456*")]
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_random_tables(seed):
+    rng = np.random.default_rng(seed)
+    values = rng.integers(0, 3*10**6, size=(12, 6))
+    cells = [[f"{value:,}".replace(",", ".") for value in row] for row in values]
+    for row in cells:
+        k = rng.integers(1, 6)
+        row[k] = rng.choice(["", "-", f"{row[k]} ({rng.integers(100)},{rng.integers(10)}%)"])
+    raw_df = pd.DataFrame([["età"] + row for row in cells])
+
+    clean_df = dati_selezione.clean_raw_table(raw_df)
+    pd.testing.assert_frame_equal(clean_df, clean_raw_table_regex(raw_df))
+    assert not clean_df.attrs["parse_failures"]
@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+
+from custom.preprocessing_dataframe import (EVENTI, STATI_VACCINALI, compose_labels,
+                                            compute_efficacia_cube)
+
+
+def safe_div(df, col1, col2):
+    """ La versione precedente, riga per riga """
+    return df.apply(lambda x: x[col2] and x[col1]/x[col2] or 0, axis=1)
+
+
+def tassi(seed=0):
+    """ Incidenze casuali con denominatori nulli e NaN """
+    rng = np.random.default_rng(seed)
+    colonne = compose_labels(EVENTI, ["%s non vaccinati"] + [f"%s {stato}" for stato in STATI_VACCINALI])
+    valori = rng.uniform(0, 500, size=(20, len(colonne)))
+    valori[rng.random(valori.shape) < 0.15] = 0
+    valori[rng.random(valori.shape) < 0.15] = np.nan
+    index = pd.date_range("2022-01-05", periods=len(valori), freq="7D", name="data")
+    return pd.DataFrame(valori, index=index, columns=colonne)
+
+
+def test_come_safe_div():
+    df_tassi = tassi()
+    efficacia = compute_efficacia_cube(df_tassi)
+
+    for evento in EVENTI:
+        for stato in STATI_VACCINALI:
+            attesa = (1 - safe_div(df_tassi, f"{evento} {stato}", f"{evento} non vaccinati"))*100
+            np.testing.assert_allclose(efficacia[(evento, stato)].to_numpy(),
+                                       attesa.to_numpy(dtype=float))
+
+
+def test_denominatore_nullo_e_nan():
+    df_tassi = tassi()
+    df_tassi.iloc[0] = 10.0
+    df_tassi.loc[df_tassi.index[0], "casi non vaccinati"] = 0
+    df_tassi.loc[df_tassi.index[0], "decessi non vaccinati"] = np.nan
+    df_tassi.loc[df_tassi.index[0], "ospedalizzati booster"] = np.nan
+    efficacia = compute_efficacia_cube(df_tassi).iloc[0]
+
+    # RR 0 (efficacia 100%) se il denominatore è nullo, NaN propagati
+    assert (efficacia["casi"] == 100).all()
+    assert efficacia["decessi"].isna().all()
+    assert np.isnan(efficacia[("ospedalizzati", "booster")])
+    assert efficacia["terapia intensiva"].tolist() == [0.0]*len(STATI_VACCINALI)
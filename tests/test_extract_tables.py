@@ -0,0 +1,143 @@
+import json
+import random
+
+import fitz
+import numpy as np
+import pytest
+
+import dati_selezione
+
+URL = "https://www.epicentro.iss.it/coronavirus/bollettino/report.pdf"
+AGE_GROUPS = ["5-11", "12-39", "40-59", "60-79", "80+", "Totale"]
+
+
+def make_blocks(n_blocks=2, seed=0):
+    """Blocks of 5 age groups and their total, 6 columns"""
+
+    rng = random.Random(seed)
+    blocks = []
+    for _ in range(n_blocks):
+        rows = [[rng.randint(1, 2000000) for _ in range(6)] for _ in range(5)]
+        blocks.append(rows + [[sum(col) for col in zip(*rows)]])
+    return blocks
+
+
+def make_pdf(pdf_path, blocks, separator=".", footnote=False):
+    """Writes a page with the table: labels and 6 right-aligned numeric columns"""
+
+    doc = fitz.open()
+    page = doc.new_page()
+    page.insert_text((50, 60), "TABELLA 5A - POPOLAZIONE ITALIANA", fontsize=10)
+    y = 100
+    for rows in blocks:
+        for label, row in zip(AGE_GROUPS, rows):
+            page.insert_text((60, y), label, fontsize=8)
+            for x, value in zip(range(200, 560, 60), row):
+                text = f"{value:,}".replace(",", separator)
+                width = fitz.get_text_length(text, fontsize=8)
+                page.insert_text((x + 40 - width, y), text, fontsize=8)
+            if footnote and label == "Totale":
+                page.insert_text((522, y - 3), "1", fontsize=5)
+            y += 14
+        y += 10
+    page.insert_text((300, 800), "12", fontsize=8)
+    doc.save(str(pdf_path))
+    doc.close()
+
+
+def expected(blocks):
+    return np.array([row for rows in blocks for row in rows])
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(dati_selezione, "fetched_reports", {})
+
+
+def use_pdf(tmp_path, monkeypatch, **kwargs):
+    blocks = kwargs.pop("blocks", None) or make_blocks()
+    pdf_path = tmp_path / "report.pdf"
+    make_pdf(pdf_path, blocks, **kwargs)
+    monkeypatch.setitem(dati_selezione.fetched_reports, URL, str(pdf_path))
+    return blocks
+
+
+@pytest.mark.parametrize("separator", [".", " "])
+def test_fitz_table(tmp_path, monkeypatch, separator):
+    # With " " the numbers are split into several words, e.g. "1 568 621"
+    blocks = use_pdf(tmp_path, monkeypatch, separator=separator)
+
+    clean_df = dati_selezione.clean_raw_table(dati_selezione.get_raw_table_fitz(URL, 1))
+    assert not clean_df.attrs["parse_failures"]
+    np.testing.assert_array_equal(clean_df.iloc[:, :6].to_numpy(), expected(blocks))
+
+
+def test_fitz_rejects_rows_not_matching_the_columns(tmp_path, monkeypatch):
+    use_pdf(tmp_path, monkeypatch, footnote=True)
+
+    with pytest.raises(dati_selezione.ExtractionError):
+        dati_selezione.get_raw_table_fitz(URL, 1)
+
+
+def test_fitz_falls_back_to_camelot(tmp_path, monkeypatch):
+    blocks = use_pdf(tmp_path, monkeypatch, footnote=True)
+
+    _, clean_df = dati_selezione.extract_table(URL, 1, "A", engine="fitz")
+    np.testing.assert_array_equal(clean_df.iloc[:, :6].to_numpy(), expected(blocks))
+
+
+def test_check_engine_matches_camelot(tmp_path, monkeypatch):
+    blocks = use_pdf(tmp_path, monkeypatch)
+
+    raw_df, clean_df = dati_selezione.extract_table(URL, 1, "A", engine="check")
+    np.testing.assert_array_equal(clean_df.iloc[:, :6].to_numpy(), expected(blocks))
+    # PyMuPDF table, accepted because camelot agrees
+    assert list(raw_df.columns) == list(range(6))
+
+
+def test_table_totals():
+    blocks = make_blocks()
+    clean_df = dati_selezione.clean_raw_table(
+        dati_selezione.pd.DataFrame(expected(blocks).astype(str)))
+    assert dati_selezione.check_table_totals(clean_df)
+    clean_df.iloc[5, 0] += 1
+    assert not dati_selezione.check_table_totals(clean_df)
+
+
+def test_hint_is_learned_and_used(tmp_path, monkeypatch):
+    blocks = use_pdf(tmp_path, monkeypatch)
+
+    first = dati_selezione.get_raw_table(URL, 1, "A")
+    hint = dati_selezione.load_table_hints()["A"]
+    assert hint["n_rows"] == 12 and hint["n_cols"] == len(first.columns)
+
+    second = dati_selezione.get_raw_table(URL, 1, "A")
+    np.testing.assert_array_equal(
+        dati_selezione.clean_raw_table(second).iloc[:, :6].to_numpy(), expected(blocks))
+
+
+def test_wrong_hint_is_refreshed(tmp_path, monkeypatch):
+    blocks = use_pdf(tmp_path, monkeypatch)
+    dati_selezione.get_raw_table(URL, 1, "A")
+
+    # A separator less: as many rows, but two columns merged
+    hints = dati_selezione.load_table_hints()
+    good_hint = dict(hints["A"])
+    hints["A"]["columns"] = [hints["A"]["columns"][0].rsplit(",", 1)[0]]
+    with open(dati_selezione.TABLE_HINTS_FILE, "w", encoding="utf-8") as f:
+        json.dump(hints, f)
+
+    raw_df = dati_selezione.get_raw_table(URL, 1, "A")
+    np.testing.assert_array_equal(
+        dati_selezione.clean_raw_table(raw_df).iloc[:, :6].to_numpy(), expected(blocks))
+    assert dati_selezione.load_table_hints()["A"] == good_hint
+
+
+def test_no_hint_from_inconsistent_totals(tmp_path, monkeypatch):
+    blocks = make_blocks()
+    blocks[0][5][0] += 1
+    use_pdf(tmp_path, monkeypatch, blocks=blocks)
+
+    dati_selezione.get_raw_table(URL, 1, "A")
+    assert "A" not in dati_selezione.load_table_hints()
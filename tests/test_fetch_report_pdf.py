@@ -0,0 +1,105 @@
+import threading
+from functools import partial
+from glob import glob
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from os import path
+
+import pytest
+
+import dati_selezione
+
+
+class RecordingHandler(SimpleHTTPRequestHandler):
+    """Serves the files of a directory, recording method, path and status"""
+
+    requests = []
+
+    def send_response(self, code, message=None):
+        self.requests.append((self.command, self.path, code,
+                              self.headers.get("If-Modified-Since")))
+        super().send_response(code, message)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server(tmp_path):
+    root = tmp_path / "www"
+    root.mkdir()
+    (root / "report.pdf").write_bytes(b"%PDF-1.4 first version")
+    RecordingHandler.requests = []
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0),
+                                partial(RecordingHandler, directory=str(root)))
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield root, f"http://127.0.0.1:{httpd.server_address[1]}/report.pdf"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture(autouse=True)
+def new_run(monkeypatch):
+    monkeypatch.setattr(dati_selezione, "fetched_reports", {})
+
+
+def test_cache_miss_downloads_once(server, tmp_path):
+    _, url = server
+    cache_dir = str(tmp_path / "cache")
+
+    pdf_path = dati_selezione.fetch_report_pdf(url, cache_dir)
+    with open(pdf_path, "rb") as f:
+        assert f.read() == b"%PDF-1.4 first version"
+    assert dati_selezione.load_pdf_index(cache_dir)[url]["last_modified"]
+    assert not glob(path.join(cache_dir, "*.tmp"))
+
+    # Same run: no request at all
+    assert dati_selezione.fetch_report_pdf(url, cache_dir) == pdf_path
+    assert [code for _, _, code, _ in RecordingHandler.requests] == [200]
+
+
+def test_cache_hit_is_revalidated(server, tmp_path, monkeypatch):
+    _, url = server
+    cache_dir = str(tmp_path / "cache")
+    pdf_path = dati_selezione.fetch_report_pdf(url, cache_dir)
+
+    # Next run: conditional request, answered with 304
+    monkeypatch.setattr(dati_selezione, "fetched_reports", {})
+    assert dati_selezione.fetch_report_pdf(url, cache_dir) == pdf_path
+    _, _, code, if_modified_since = RecordingHandler.requests[-1]
+    assert code == 304
+    assert if_modified_since == dati_selezione.load_pdf_index(cache_dir)[url]["last_modified"]
+
+
+def test_changed_report_is_downloaded_again(server, tmp_path, monkeypatch):
+    root, url = server
+    cache_dir = str(tmp_path / "cache")
+    first_path = dati_selezione.fetch_report_pdf(url, cache_dir)
+
+    (root / "report.pdf").write_bytes(b"%PDF-1.4 second version")
+    monkeypatch.setattr(dati_selezione, "fetched_reports", {})
+    # Drop the validators: the mtime may not change within the same second
+    pdf_index = dati_selezione.load_pdf_index(cache_dir)
+    pdf_index[url]["last_modified"] = None
+    dati_selezione.save_pdf_index(pdf_index, cache_dir)
+
+    second_path = dati_selezione.fetch_report_pdf(url, cache_dir)
+    assert second_path != first_path
+    with open(second_path, "rb") as f:
+        assert f.read() == b"%PDF-1.4 second version"
+    assert path.exists(first_path)
+
+
+def test_interrupted_write_leaves_the_cache_unchanged(server, tmp_path, monkeypatch):
+    _, url = server
+    cache_dir = str(tmp_path / "cache")
+
+    def crash(src, dst):
+        raise OSError("interrupted")
+
+    monkeypatch.setattr(dati_selezione, "replace", crash)
+    with pytest.raises(OSError):
+        dati_selezione.fetch_report_pdf(url, cache_dir)
+    assert not glob(path.join(cache_dir, "*.pdf"))
+    assert dati_selezione.load_pdf_index(cache_dir) == {}
+    assert url not in dati_selezione.fetched_reports
@@ -0,0 +1,86 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from custom import preprocessing_dataframe
+from custom.preprocessing_dataframe import (DENOMINATORI, EVENTI, STATI_VACCINALI,
+                                            compose_labels, compute_incidence,
+                                            compute_incidence_std)
+
+FASCE = ["5-11", "12-39", "40-59", "60-79", "80+"]
+TEMPLATES = [f"%s {stato}" for stato in ["non vaccinati"] + STATI_VACCINALI]
+PLATEA = pd.DataFrame({"totale_popolazione": [3.6e6, 18.5e6, 18.1e6, 13.4e6, 4.5e6]},
+                      index=FASCE)
+
+
+def dati_età(seed=0):
+    """ Dati per data ed età, con popolazioni nulle, date precedenti
+    al 29/07/2021 e una fascia d'età mancante """
+    rng = np.random.default_rng(seed)
+    date = pd.date_range("2021-07-14", periods=8, freq="7D")
+    index = pd.DatetimeIndex(np.repeat(date, len(FASCE)), name="data")
+    colonne_epid = compose_labels(EVENTI, TEMPLATES)
+    colonne_pop = sorted(set(compose_labels(DENOMINATORI.values(), TEMPLATES)))
+    df_epid = pd.DataFrame(rng.integers(0, 1000, size=(len(index), len(colonne_epid))),
+                           index=index, columns=colonne_epid)
+    df_pop = pd.DataFrame(rng.integers(0, 10**6, size=(len(index), len(colonne_pop))),
+                          index=index, columns=colonne_pop)
+    df_pop.iloc[22, 3] = 0
+    for df in (df_epid, df_pop):
+        df.insert(0, "età", FASCE*len(date))
+    # 04/08/2021, 40-59
+    righe = np.arange(len(index)) != 17
+    return df_epid[righe], df_pop[righe]
+
+
+def incidenza_std_merge(df_epid, df_pop, df_pesi):
+    """ La versione precedente, con merge e groupby """
+    df_età_epid = df_epid.reset_index().set_index("età")
+    df_età_pop = df_pop.reset_index().set_index("età")
+    df_età_epid = df_età_epid[df_età_epid.index != "5-11"]
+    df_età_pop = df_età_pop[df_età_pop.index != "5-11"]
+    df_età_epid = df_età_epid[df_età_epid["data"] > "2021-07-28"]
+    df_età_pop = df_età_pop[df_età_pop["data"] > "2021-07-28"]
+
+    df_tassi, _ = compute_incidence(df_età_epid, df_età_pop)
+    df_tassi.index = df_età_epid.index
+    df_tassi = df_tassi.reset_index()
+    df_tassi.index = df_età_epid["data"]
+
+    df_pesi = df_pesi[df_pesi.index != "5-11"]
+    df_tassi_ = df_tassi.reset_index().merge(df_pesi, how="left", left_on="età",
+                                             right_on=df_pesi.index,
+                                             sort=False).set_index("data")
+    weights = df_tassi_["totale_popolazione"].to_numpy()
+    weights_sum = df_pesi["totale_popolazione"].sum()
+    df_tassi_adj = df_tassi_.iloc[:, 1:-1].mul(weights, axis=0).reset_index()
+    # con pandas 1.2 agg(sum) era la somma di groupby, che salta i NaN
+    df_tassi_adj = df_tassi_adj.groupby("data").agg("sum")
+    df_tassi_adj = df_tassi_adj.apply(lambda x: x/weights_sum)
+    return df_tassi_adj.replace(0, np.nan)
+
+
+@pytest.fixture
+def dati(monkeypatch):
+    df_epid, df_pop = dati_età()
+    monkeypatch.setattr(preprocessing_dataframe, "read_dati_iss",
+                        lambda filename: (df_epid.copy(), df_pop.copy()))
+    monkeypatch.setattr(preprocessing_dataframe, "_get_df_popolazione", lambda: PLATEA)
+    preprocessing_dataframe._cubo_tassi_età.cache_clear()
+    preprocessing_dataframe._pesi_standard.cache_clear()
+    yield df_epid, df_pop
+    preprocessing_dataframe._cubo_tassi_età.cache_clear()
+    preprocessing_dataframe._pesi_standard.cache_clear()
+
+
+def test_come_merge_groupby(dati):
+    attesi = incidenza_std_merge(*dati, PLATEA)
+    tassi_std = compute_incidence_std()
+    pd.testing.assert_frame_equal(tassi_std, attesi, check_freq=False, check_names=False)
+
+
+def test_esp2013(dati):
+    pesi = pd.DataFrame({"totale_popolazione": preprocessing_dataframe.ESP2013})
+    attesi = incidenza_std_merge(*dati, pesi)
+    tassi_std = compute_incidence_std("ESP2013")
+    pd.testing.assert_frame_equal(tassi_std, attesi, check_freq=False, check_names=False)
@@ -0,0 +1,86 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from custom.preprocessing_dataframe import (DENOMINATORI, EVENTI, STATI_VACCINALI,
+                                            compose_labels, compute_efficacia_ci,
+                                            compute_incidence_ci, compute_incidence_cube,
+                                            poisson_ci, quantile_normale)
+
+STATI = ["non vaccinati"] + STATI_VACCINALI
+
+
+def dati_età(eventi_vacc, eventi_non_vacc, pop_vacc=1000, pop_non_vacc=1000):
+    """ Una data e una fascia d'età, stessi valori per tutti gli eventi e stati """
+    index = pd.DatetimeIndex(["2022-07-05"], name="data")
+    templates = [f"%s {stato}" for stato in STATI]
+    colonne_epid = compose_labels(EVENTI, templates)
+    colonne_pop = sorted(set(compose_labels(DENOMINATORI.values(), templates)))
+    df_epid = pd.DataFrame([[eventi_non_vacc if col.endswith("non vaccinati") else eventi_vacc
+                             for col in colonne_epid]], index=index, columns=colonne_epid)
+    df_pop = pd.DataFrame([[pop_non_vacc if col.endswith("non vaccinati") else pop_vacc
+                            for col in colonne_pop]], index=index, columns=colonne_pop)
+    df_epid.insert(0, "età", "60-79")
+    df_pop.insert(0, "età", "60-79")
+    return df_epid, df_pop
+
+
+@pytest.mark.parametrize("livello, z", [(0.90, 1.6448536), (0.95, 1.9599640), (0.99, 2.5758293)])
+def test_quantile_normale(livello, z):
+    assert quantile_normale((1 + livello)/2) == pytest.approx(z, abs=1e-7)
+
+
+def test_poisson_ci():
+    inf, sup = poisson_ci([0, 10, 100])
+    # limiti esatti (chi quadro): 0-3.689, 4.795-18.39, 81.36-121.63
+    assert inf[0] == 0
+    np.testing.assert_allclose(inf[1:], [4.795, 81.36], rtol=5e-3)
+    np.testing.assert_allclose(sup, [3.689, 18.39, 121.63], rtol=1e-2)
+
+
+def test_compute_incidence_ci():
+    df_epid, df_pop = dati_età(10, 40, pop_vacc=10**5, pop_non_vacc=2*10**5)
+    inf, sup = compute_incidence_ci(df_epid, df_pop)
+    inf_10, sup_10 = poisson_ci([10])
+    assert inf["casi booster"].iloc[0] == pytest.approx(inf_10[0])
+    assert sup["casi booster"].iloc[0] == pytest.approx(sup_10[0])
+    assert (inf["decessi non vaccinati"] < 20).all() and (sup["decessi non vaccinati"] > 20).all()
+
+
+def test_compute_efficacia_ci_log_rr():
+    a, b = 10, 40
+    df_epid, df_pop = dati_età(a, b)
+    inf, sup = compute_efficacia_ci(df_epid, df_pop)
+
+    # RR = 0.25, exp(log RR ± z*sqrt(1/a + 1/b))
+    errore = 1.959964*np.sqrt(1/a + 1/b)
+    assert inf.shape == (1, len(EVENTI)*len(STATI_VACCINALI))
+    np.testing.assert_allclose(inf.to_numpy(), (1 - 0.25*np.exp(errore))*100, rtol=1e-6)
+    np.testing.assert_allclose(sup.to_numpy(), (1 - 0.25*np.exp(-errore))*100, rtol=1e-6)
+
+
+def test_compute_efficacia_ci_senza_eventi():
+    df_epid, df_pop = dati_età(10, 0)
+    inf, sup = compute_efficacia_ci(df_epid, df_pop)
+    assert inf.isna().all().all() and sup.isna().all().all()
+
+
+def test_compute_efficacia_ci_bootstrap():
+    df_epid, df_pop = dati_età(100, 400)
+    inf, sup = compute_efficacia_ci(df_epid, df_pop, n_bootstrap=500, seed=1, batch=64)
+    inf_2, sup_2 = compute_efficacia_ci(df_epid, df_pop, n_bootstrap=500, seed=1, batch=64)
+
+    # stesso seme: stessi limiti
+    pd.testing.assert_frame_equal(inf, inf_2)
+    pd.testing.assert_frame_equal(sup, sup_2)
+    # vicini agli intervalli log-RR
+    inf_rr, sup_rr = compute_efficacia_ci(df_epid, df_pop)
+    np.testing.assert_allclose(inf.to_numpy(), inf_rr.to_numpy(), atol=2)
+    np.testing.assert_allclose(sup.to_numpy(), sup_rr.to_numpy(), atol=2)
+
+
+@pytest.mark.filterwarnings("error::RuntimeWarning")
+def test_rapporto_senza_eventi():
+    df_epid, df_pop = dati_età(0, 0)
+    rapporto = compute_incidence_cube(df_epid, df_pop)["rapporto"]
+    assert rapporto.isna().all().all()
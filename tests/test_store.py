@@ -0,0 +1,175 @@
+from os import path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import dati_selezione
+import iss_store
+
+
+def frames(dates, by_age=False, offset=0):
+    """Epidemiological and populations rows for the dates, from the most recent"""
+
+    index = pd.DatetimeIndex(sorted(pd.to_datetime(dates), reverse=True), name="data")
+    if by_age:
+        index = index.repeat(2)
+    values = np.arange(len(index)*2, dtype=np.int64).reshape(-1, 2) + offset
+    df_0 = pd.DataFrame(values, index=index, columns=["casi non vaccinati", "casi vaccinati"])
+    df_1 = pd.DataFrame(values*100, index=index, columns=["casi non vaccinati", "casi vaccinati"])
+    if by_age:
+        for sel_df in (df_0, df_1):
+            sel_df.insert(0, "età", ["60-79", "80+"]*(len(index)//2))
+    return df_0, df_1
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+
+@pytest.mark.parametrize("by_age", [False, True])
+def test_store_round_trip(by_age):
+    df_0, df_1 = frames(["2022-06-28", "2022-07-05"], by_age)
+    dati_selezione.write_store(df_0, df_1, "dati")
+
+    read_0, read_1 = iss_store.read_store("dati")
+    pd.testing.assert_frame_equal(read_0, df_0, check_freq=False)
+    pd.testing.assert_frame_equal(read_1, df_1, check_freq=False)
+
+
+def test_store_is_created_from_the_xlsx():
+    df_0, df_1 = frames(["2022-06-28", "2022-07-05"])
+    dati_selezione.merge_df_into_xlsx(df_0, df_1, "dati.xlsx")
+
+    read_0, _ = dati_selezione.read_store("dati")
+    assert all(path.exists(store_path) for store_path in iss_store.store_paths("dati"))
+    assert list(read_0.index) == list(df_0.index)
+
+
+def test_unsupported_schema_version(monkeypatch):
+    dati_selezione.write_store(*frames(["2022-06-28"]), "dati")
+    monkeypatch.setattr(iss_store, "STORE_SCHEMA_VERSION", "0")
+    with pytest.raises(ValueError):
+        iss_store.read_store("dati")
+
+
+def test_log_is_replayed_in_order():
+    dati_selezione.write_store(*frames(["2022-06-28", "2022-07-05"]), "dati")
+    iss_store.append_to_log(*frames(["2022-07-12"]), "dati")
+    # A re-extracted report replaces the rows of its date
+    new_0, new_1 = frames(["2022-07-05"], offset=1000)
+    iss_store.append_to_log(new_0, new_1, "dati")
+
+    read_0, _ = iss_store.read_store("dati")
+    assert list(read_0.index.strftime("%Y-%m-%d")) == ["2022-07-12", "2022-07-05", "2022-06-28"]
+    assert read_0.loc["2022-07-05", "casi non vaccinati"] == 1000
+
+
+def test_corrupted_log_line_is_ignored():
+    dati_selezione.write_store(*frames(["2022-06-28"]), "dati")
+    iss_store.append_to_log(*frames(["2022-07-05"]), "dati")
+    iss_store.append_to_log(*frames(["2022-07-12"]), "dati")
+
+    # A crash in the middle of the last line
+    log_file = iss_store.store_log_path("dati")
+    with open(log_file, encoding="utf-8") as f:
+        lines = f.readlines()
+    with open(log_file, "w", encoding="utf-8") as f:
+        f.write(lines[0] + lines[1][:len(lines[1])//2])
+
+    assert len(iss_store.read_log("dati")) == 1
+    read_0, _ = iss_store.read_store("dati")
+    assert read_0.index.max() == pd.Timestamp("2022-07-05")
+
+
+def test_append_data_compacts_every_few_entries(monkeypatch):
+    monkeypatch.setattr(dati_selezione, "STORE_COMPACT_EVERY", 2)
+    dati_selezione.write_store(*frames(["2022-06-28"]), "dati")
+
+    dati_selezione.append_data(*frames(["2022-07-05"]), "dati")
+    assert len(iss_store.read_log("dati")) == 1
+    assert not path.exists("dati.xlsx")
+
+    dati_selezione.append_data(*frames(["2022-07-12"]), "dati")
+    assert not path.exists(iss_store.store_log_path("dati"))
+    df_xlsx, _ = iss_store.read_xlsx_data("dati.xlsx")
+    assert len(df_xlsx) == 3
+    assert len(iss_store.read_parquet_store("dati")[0]) == 3
+
+
+def test_store_index_tracks_the_log():
+    df_0, df_1 = frames(["2022-06-28", "2022-07-05"], by_age=True)
+    dati_selezione.write_store(df_0, df_1, "dati")
+    store_index = dati_selezione.load_store_index("dati")
+    assert dati_selezione.is_stored(store_index, df_0, df_1)
+
+    new_0, new_1 = frames(["2022-07-05"], by_age=True, offset=1000)
+    assert not dati_selezione.is_stored(store_index, new_0, new_1)
+
+    # The index is rebuilt once the log changes
+    iss_store.append_to_log(new_0, new_1, "dati")
+    store_index = dati_selezione.load_store_index("dati")
+    assert dati_selezione.is_stored(store_index, new_0, new_1)
+
+
+def test_upsert_rows_keeps_the_most_recent_first():
+    df_0, _ = frames(["2022-06-28", "2022-07-12"])
+    new_0, _ = frames(["2022-07-05", "2022-07-19"], offset=100)
+
+    merged = iss_store.upsert_rows(df_0, new_0)
+    assert list(merged.index.strftime("%Y-%m-%d")) == ["2022-07-19", "2022-07-12",
+                                                       "2022-07-05", "2022-06-28"]
+
+
+def test_append_after_a_torn_line():
+    dati_selezione.write_store(*frames(["2022-06-28"]), "dati")
+    iss_store.append_to_log(*frames(["2022-07-05"]), "dati")
+
+    # A crash in the middle of an append, then two more reports
+    log_file = iss_store.store_log_path("dati")
+    with open(log_file, "a", encoding="utf-8") as f:
+        f.write('{"sha256": "12')
+    iss_store.append_to_log(*frames(["2022-07-12"]), "dati")
+    iss_store.append_to_log(*frames(["2022-07-19"]), "dati")
+
+    assert len(iss_store.read_log("dati")) == 3
+    read_0, _ = iss_store.read_store("dati")
+    assert read_0.index.max() == pd.Timestamp("2022-07-19")
+
+
+def test_corrupted_line_in_the_middle_is_kept():
+    dati_selezione.write_store(*frames(["2022-06-28"]), "dati")
+    for date in ["2022-07-05", "2022-07-12", "2022-07-19"]:
+        iss_store.append_to_log(*frames([date]), "dati")
+
+    log_file = iss_store.store_log_path("dati")
+    with open(log_file, encoding="utf-8") as f:
+        lines = f.readlines()
+    lines[1] = lines[1].replace("sha256", "sha265")
+    with open(log_file, "w", encoding="utf-8") as f:
+        f.writelines(lines)
+
+    # Neither appending nor compacting may lose the last entry
+    with pytest.raises(ValueError):
+        iss_store.append_to_log(*frames(["2022-07-26"]), "dati")
+    with pytest.raises(ValueError):
+        dati_selezione.compact_store("dati", export_xlsx=False)
+    with open(log_file, encoding="utf-8") as f:
+        assert f.readlines() == lines
+
+
+def test_compact_without_log_keeps_the_xlsx():
+    dati_selezione.write_store(*frames(["2022-06-28"]), "dati")
+    dati_selezione.compact_store("dati")
+    assert path.exists("dati.xlsx")
+    mtime = path.getmtime("dati.xlsx")
+
+    # Nothing new: the published xlsx is not rewritten
+    dati_selezione.compact_store("dati")
+    assert path.getmtime("dati.xlsx") == mtime
+
+    dati_selezione.append_data(*frames(["2022-07-05"]), "dati", export_xlsx=False)
+    dati_selezione.compact_store("dati")
+    df_xlsx, _ = iss_store.read_xlsx_data("dati.xlsx")
+    assert len(df_xlsx) == 2
@@ -14,14 +14,13 @@ if [[ -z "$(git status --porcelain)" ]];
 then
   printf "No changes to commit!\n"
 else
+  # Consolidate the log into the store and export the published xlsx
+  printf "\nExporting the xlsx...\n"
+  python dati/dati_selezione.py --compact
+
   # Update the results
   printf "\nUpdating results...\n"
-  python scripts/andamento_epidemia.py
-  python scripts/andamento_rapporti_incidenze.py
-  python scripts/efficacia_vaccini.py
-  python scripts/confronto_2020_2021.py
-  python scripts/confronti_europei.py
-  python scripts/confronti_europei_map.py
+  python scripts/aggiorna_risultati.py
 
   printf "\nDONE!\n"
 fi